@@ -0,0 +1,71 @@
+import struct
+import ujson
+import logger
+
+PACK_FILE = "www.pack"
+PACK_MAGIC = b"WPK1"
+HEADER_FORMAT = "<4sI"
+HEADER_SIZE = 8
+
+
+class AssetPack:
+    """
+    tools/pack_www.py が www/ をまとめた 1 つのファイルから静的ファイルを返す
+
+    ファイル構成: ヘッダー (magic, インデックス長) + JSON インデックス + 本文
+    インデックス: {"/style.css": [content_type, etag, offset, length, gz_offset, gz_length], ...}
+    offset はインデックス直後からの位置。gz_length が 0 なら gzip 版はない。
+    起動時にインデックスだけを読み、ファイルは開いたまま seek して読む。
+    """
+
+    def __init__(self, path=PACK_FILE):
+        self.index = {}
+        self.file = None
+        self.base = 0
+        try:
+            self.load(path)
+        except OSError:
+            # パックがなければ www/ のファイルを個別に返す
+            pass
+        except ValueError as error:
+            logger.error("Asset pack load error: {}".format(error))
+
+    def load(self, path):
+        file_obj = open(path, "rb")
+        try:
+            magic, index_len = struct.unpack(HEADER_FORMAT, file_obj.read(HEADER_SIZE))
+            if magic != PACK_MAGIC:
+                raise ValueError("bad magic")
+            self.index = ujson.loads(file_obj.read(index_len))
+        except Exception:
+            file_obj.close()
+            raise
+        self.file = file_obj
+        self.base = HEADER_SIZE + index_len
+
+    def find(self, path):
+        return self.index.get(path)
+
+    def read(self, path):
+        # 圧縮していない本文を丸ごと返す (テンプレートなど小さいファイル用)
+        entry = self.index.get(path)
+        if not entry:
+            return None
+        self.file.seek(self.base + entry[2])
+        return self.file.read(entry[3])
+
+    async def write_range(self, writer, offset, length, buf):
+        # 複数の接続が同じファイルを共有するため、読む直前に毎回 seek する
+        pos = self.base + offset
+        remaining = length
+        bufsize = len(buf)
+        while remaining > 0:
+            self.file.seek(pos)
+            n = self.file.readinto(buf[:min(bufsize, remaining)])
+            if not n:
+                break
+            writer.write(buf[:n])
+            pos += n
+            remaining -= n
+            await writer.drain()
+        return length - remaining
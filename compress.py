@@ -0,0 +1,84 @@
+import io
+
+try:
+    # MicroPython 1.21 以降 (圧縮はビルドで有効になっている場合のみ使える)
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    # ホスト (CPython) で同じ処理を確かめる用
+    import zlib
+except ImportError:
+    zlib = None
+
+# 窓の大きさ (2^wbits バイト) の範囲。大きいほど縮むが、ヒープと CPU 時間を多く使う
+COMPRESS_MIN_WBITS = 9
+COMPRESS_MAX_WBITS = 12
+# 窓に使うのはヒープ残量の 1/COMPRESS_HEAP_DIVISOR まで
+COMPRESS_HEAP_DIVISOR = 8
+# これより小さい本文は圧縮しない (gzip のヘッダーと末尾だけで 18 バイトある)
+COMPRESS_MIN_SIZE = 256
+
+
+def choose_wbits(free, max_wbits=COMPRESS_MAX_WBITS):
+    """ヒープ残量 free に収まる最大の窓を選ぶ。最小の窓も収まらなければ 0 (圧縮しない)"""
+    wbits = max_wbits
+    while wbits >= COMPRESS_MIN_WBITS:
+        if (1 << wbits) * COMPRESS_HEAP_DIVISOR <= free:
+            return wbits
+        wbits -= 1
+    return 0
+
+
+class GzipEncoder:
+    """
+    compress に渡した断片を gzip に圧縮し、出来上がった分を返す
+    MicroPython では deflate.DeflateIO、ホストでは zlib.compressobj を使う (出力はどちらも gzip)。
+    本文全体を溜めないので、使うメモリは窓 (2^wbits バイト) と出力待ちの分だけ。
+    """
+
+    def __init__(self, wbits):
+        if deflate:
+            # DeflateIO が書き出した圧縮済みのバイト列を溜める。_take で取り出して先頭に戻し、確保済みの領域を使い回す
+            self.sink = io.BytesIO()
+            self.stream = deflate.DeflateIO(self.sink, deflate.GZIP, wbits)
+        else:
+            self.sink = None
+            self.stream = zlib.compressobj(6, zlib.DEFLATED, 16 + wbits)
+
+    def compress(self, data):
+        if self.sink is None:
+            return self.stream.compress(data)
+        self.stream.write(data)
+        return self._take()
+
+    def finish(self):
+        # 残りと gzip の末尾 (CRC32 と長さ) を返す。これ以降は使えない
+        if self.sink is None:
+            return self.stream.flush()
+        self.stream.close()
+        return self._take()
+
+    def _take(self):
+        # 先頭に戻した後の書き込みは前回の分を上書きするだけなので、今回書かれた長さだけ読む
+        size = self.sink.tell()
+        self.sink.seek(0)
+        data = self.sink.read(size)
+        self.sink.seek(0)
+        return data
+
+
+def _probe():
+    # deflate があっても、圧縮を含めずにビルドされたファームウェアでは書き込みが失敗する
+    if not deflate and not (zlib and hasattr(zlib, "compressobj")):
+        return False
+    try:
+        encoder = GzipEncoder(COMPRESS_MIN_WBITS)
+        encoder.compress(b"{}")
+        encoder.finish()
+        return True
+    except Exception:
+        return False
+
+
+AVAILABLE = _probe()
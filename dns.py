@@ -1,60 +1,361 @@
 import socket
-import uselect
+import select
+import errno
+import struct
+import time
+import ujson
 import uasyncio as asyncio
 import gc
+from array import array
+
+# UDP の DNS メッセージの上限 (EDNS なし)
+DNS_MAX_PACKET = 512
+# 回答の TTL と、否定応答 (NODATA) をキャッシュさせる秒数 (SOA の MINIMUM)
+DNS_TTL = 60
+
+# 名前ごとの集計表の件数と、名前ごとに指定した応答の保存先
+DNS_NAME_TABLE_SIZE = 32
+DNS_RULES_PATH = "/data/dns_rules.json"
+# uasyncio の I/O キューを使えない場合に、クエリが届いたかを確かめる間隔
+DNS_POLL_MS = 20
+
+# 名前ごとの応答。default は型に合わせて A か NODATA
+ACTION_DEFAULT = 0
+ACTION_NXDOMAIN = 1
+ACTION_NODATA = 2
+ACTION_NAMES = ("default", "nxdomain", "nodata")
+
+QTYPE_A = 1
+QTYPE_ANY = 255
+QCLASS_IN = 1
+
+# ID の後ろのヘッダー (フラグ、質問数、回答数、権威数、追加数)
+# A: 応答・再帰可・NOERROR、回答 1
+_ANSWER_HEADER = b"\x81\x80\x00\x01\x00\x01\x00\x00\x00\x00"
+# NODATA: NOERROR で回答 0、権威に SOA 1 (AAAA や HTTPS には「その型のレコードはない」と返す)
+_NODATA_HEADER = b"\x81\x80\x00\x01\x00\x00\x00\x01\x00\x00"
+# NXDOMAIN: その名前は存在しない (権威に SOA 1)。再送をやめさせたい名前に返す
+_NXDOMAIN_HEADER = b"\x81\x83\x00\x01\x00\x00\x00\x01\x00\x00"
+# FORMERR (解析できないクエリ) と NOTIMP (標準の問い合わせ以外)。質問は返さない
+_FORMERR_HEADER = b"\x81\x81\x00\x00\x00\x00\x00\x00\x00\x00"
+_NOTIMP_HEADER = b"\x81\x84\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def skip_name(data, i, n):
+    """
+    data[i:n] から始まる名前の次の位置を返す。範囲を超える名前や不正なラベルは -1
+    圧縮ポインター (上位 2 ビットが 11) があれば、そこで名前が終わる (指す先は読まない)
+    """
+    while i < n:
+        length = data[i]
+        if length == 0:
+            return i + 1
+        if length & 0xC0 == 0xC0:
+            return i + 2 if i + 2 <= n else -1
+        if length & 0xC0:
+            # 予約されたラベルの種類
+            return -1
+        i += 1 + length
+    return -1
+
+
+def _name_hash(data, start, end):
+    # 英字の大小を区別しない。24 ビットに収めて small int のまま計算する
+    h = 0
+    for i in range(start, end):
+        c = data[i]
+        if 0x41 <= c <= 0x5A:
+            c |= 0x20
+        h = (h * 31 + c) & 0xFFFFFF
+    return h
+
+
+def _name_equals(data, start, end, name):
+    if end - start != len(name):
+        return False
+    for i in range(start, end):
+        c = data[i]
+        if 0x41 <= c <= 0x5A:
+            c |= 0x20
+        if c != name[i - start]:
+            return False
+    return True
+
+
+def name_to_text(name):
+    labels = []
+    i = 0
+    while i < len(name) and name[i] and not name[i] & 0xC0:
+        length = name[i]
+        try:
+            labels.append(bytes(name[i + 1:i + 1 + length]).decode())
+        except UnicodeError:
+            labels.append("?")
+        i += 1 + length
+    return ".".join(labels)
+
+
+def text_to_name(text):
+    # "example.com" をワイヤー形式 (小文字) にする。長すぎるラベルや名前は ValueError
+    name = bytearray()
+    for label in text.lower().strip(".").split("."):
+        label = label.encode()
+        if not label or len(label) > 63:
+            raise ValueError("bad label")
+        name.append(len(label))
+        name.extend(label)
+    name.append(0)
+    if len(name) > 255:
+        raise ValueError("name too long")
+    return bytes(name)
+
+
+class NameTable:
+    """
+    問い合わせのあった名前 (ワイヤー形式、英字は小文字) ごとの件数・最終時刻・応答の種類を固定長の表に持つ
+
+    ハッシュ値の array を先に比べ、一致したものだけ名前をバイト単位で比べるので、
+    表に既にある名前では何も確保しない。満杯なら件数の最も少ない名前 (応答を指定したものを除く) と入れ替える。
+    """
+
+    def __init__(self, size=DNS_NAME_TABLE_SIZE):
+        self.names = [None] * size
+        self.hashes = array("L", [0] * size)
+        self.counts = array("L", [0] * size)
+        self.last_seen = array("l", [0] * size)
+        self.actions = bytearray(size)
+
+    def find(self, data, start, end, h):
+        names = self.names
+        for i in range(len(names)):
+            if names[i] is not None and self.hashes[i] == h and _name_equals(data, start, end, names[i]):
+                return i
+        return -1
+
+    def hit(self, data, start, end):
+        # data[start:end] の名前を数え、その枠を返す (入れる場所がなければ -1)
+        h = _name_hash(data, start, end)
+        i = self.find(data, start, end, h)
+        if i < 0:
+            i = self._victim()
+            if i < 0:
+                return -1
+            name = bytearray(data[start:end])
+            for j in range(len(name)):
+                if 0x41 <= name[j] <= 0x5A:
+                    name[j] |= 0x20
+            self._assign(i, bytes(name), h)
+        self.counts[i] += 1
+        self.last_seen[i] = time.ticks_ms()
+        return i
+
+    def _victim(self):
+        victim = -1
+        for i in range(len(self.names)):
+            if self.names[i] is None:
+                return i
+            if self.actions[i] == ACTION_DEFAULT and (victim < 0 or self.counts[i] < self.counts[victim]):
+                victim = i
+        return victim
+
+    def _assign(self, i, name, h):
+        self.names[i] = name
+        self.hashes[i] = h
+        self.counts[i] = 0
+        self.last_seen[i] = 0
+        self.actions[i] = ACTION_DEFAULT
+
+    def set_action(self, name, action):
+        # name はワイヤー形式。default に戻した名前は、通常の名前と同じく入れ替えの対象になる
+        h = _name_hash(name, 0, len(name))
+        i = self.find(name, 0, len(name), h)
+        if i < 0:
+            if action == ACTION_DEFAULT:
+                return
+            i = self._victim()
+            if i < 0:
+                raise ValueError("name table is full")
+            self._assign(i, name, h)
+        self.actions[i] = action
+
+    def rules(self):
+        return {name_to_text(self.names[i]): ACTION_NAMES[self.actions[i]]
+                for i in range(len(self.names)) if self.names[i] is not None and self.actions[i]}
+
+    def report(self):
+        now = time.ticks_ms()
+        entries = [{"name": name_to_text(self.names[i]), "count": self.counts[i],
+                    "last_seen_ms_ago": time.ticks_diff(now, self.last_seen[i]) if self.counts[i] else None,
+                    "action": ACTION_NAMES[self.actions[i]]}
+                   for i in range(len(self.names)) if self.names[i] is not None]
+        entries.sort(key=lambda e: e["count"], reverse=True)
+        return entries
+
+
+# ---- uasyncio の内部に頼る部分 (ここだけ) ----
+# 公開 API にはデータグラムソケットを待つ手段がないため、Stream.read が使う I/O キュー
+# (asyncio.core._io_queue) に直接登録する。内部の名前が変わってこれが使えない版では
+# poll で確かめ、届いていなければ DNS_POLL_MS 眠ってから確かめ直す
+_io_queue = getattr(getattr(asyncio, "core", None), "_io_queue", None)
+
+
+def _queue_read(sock):
+    yield _io_queue.queue_read(sock)
+
+
+async def _poll_readable(sock):
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    while not poller.poll(0):
+        await asyncio.sleep_ms(DNS_POLL_MS)
+
+
+def _wait_readable(sock):
+    # sock が読めるようになるまでタスクを眠らせる
+    if _io_queue is not None and hasattr(_io_queue, "queue_read"):
+        return _queue_read(sock)
+    return _poll_readable(sock)
 
 
 class DNSServer:
-    def __init__(self, ip="192.168.4.1", port=53):
+    def __init__(self, ip="192.168.4.1", port=53, ttl=DNS_TTL, rules_path=DNS_RULES_PATH):
         gc.threshold(1024 * 8)
         self.ip = ip
         self.port = port
+        self.ttl = ttl
+        # キャプティブポータルの検出を調整するための、名前ごとの件数と応答の指定
+        self.names = NameTable()
+        self.rules_path = rules_path
+        self.load_rules()
+        # 質問の後ろに付ける部分は IP と TTL が決まれば変わらないので最初に作る (名前はどちらも質問への圧縮ポインター)
+        # A の回答: 型 A、IN、TTL、長さ 4、IP
+        self.answer = (b"\xc0\x0c" + struct.pack(">HHIH", QTYPE_A, QCLASS_IN, ttl, 4)
+                       + bytes(int(octet) for octet in ip.split(".")))
+        # NODATA の権威: SOA (MNAME と RNAME はルート、SERIAL, REFRESH, RETRY, EXPIRE, MINIMUM)
+        self.soa = (b"\xc0\x0c" + struct.pack(">HHIH", 6, QCLASS_IN, ttl, 22)
+                    + b"\x00\x00" + struct.pack(">IIIII", 1, 3600, 600, 86400, ttl))
+        # 受信と応答の組み立ては起動時に確保したバッファで行い、クエリごとに確保しない
+        self.rx = bytearray(DNS_MAX_PACKET)
+        self.rx_view = memoryview(self.rx)
+        self.tx = bytearray(DNS_MAX_PACKET + max(len(self.answer), len(self.soa)))
+        self.tx_view = memoryview(self.tx)
+        # 起床回数と処理したクエリ数 (1 回の起床でまとめて処理できているかの目安)
+        self.wakeups = 0
+        self.queries = 0
+        # 応答の種類ごとの件数。retries_saved は NODATA のうち、以前は型の違う A を返して再送させていたクエリの数
+        self.answered = 0
+        self.nodata = 0
+        self.retries_saved = 0
+        self.nxdomain = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def load_rules(self):
+        try:
+            with open(self.rules_path, "r") as f:
+                rules = ujson.load(f)
+        except (OSError, ValueError):
+            return
+        for text, action in rules.items():
+            try:
+                self.names.set_action(text_to_name(text), ACTION_NAMES.index(action))
+            except ValueError:
+                pass
+
+    def set_rule(self, text, action):
+        """名前 (例: "example.com") に返す応答を action ("default" / "nxdomain" / "nodata") にして保存する"""
+        self.names.set_action(text_to_name(text), ACTION_NAMES.index(action))
+        try:
+            with open(self.rules_path, "w") as f:
+                ujson.dump(self.names.rules(), f)
+        except OSError as e:
+            print("rules save error:", e)
+
+    def report(self):
+        return {"stats": self.stats(), "names": self.names.report()}
 
     async def start(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setblocking(False)
         self.sock.bind(("0.0.0.0", self.port))
 
-        poller = uselect.poll()
-        poller.register(self.sock, uselect.POLLIN)
+        # MicroPython のソケットには recvfrom_into がないため、その場合は recvfrom で受けて rx に写す
+        recvfrom_into = getattr(self.sock, "recvfrom_into", None)
 
+        # poll(0) で回し続けると、クエリがなくても CPU と他のタスクの順番を使い続ける。
+        # データグラムが届くまで眠り、起きたら届いている分をすべて処理する
         while True:
-            events = poller.poll(0)  # timeout = 0 (non-blocking)
-            for sock, event in events:
-                if event & uselect.POLLIN:
-                    try:
-                        data, addr = self.sock.recvfrom(512)
-                        self.handle_request(data, addr)
-                    except OSError as e:
+            await _wait_readable(self.sock)
+            self.wakeups += 1
+            while True:
+                try:
+                    if recvfrom_into:
+                        n, addr = recvfrom_into(self.rx)
+                    else:
+                        data, addr = self.sock.recvfrom(DNS_MAX_PACKET)
+                        n = len(data)
+                        self.rx_view[:n] = data
+                except OSError as e:
+                    # EAGAIN: 届いている分は処理し終えた
+                    if e.args[0] != errno.EAGAIN:
                         print("recv error:", e)
-            await asyncio.sleep(0)  # Yield control to event loop
+                    break
+                self.queries += 1
+                self.handle_request(n, addr)
+
+    def stats(self):
+        return {"wakeups": self.wakeups, "queries": self.queries, "answered": self.answered,
+                "nodata": self.nodata, "nxdomain": self.nxdomain, "errors": self.errors, "dropped": self.dropped,
+                "retries_saved": self.retries_saved}
 
-    def handle_request(self, data, addr):
-        if len(data) < 12:
+    def handle_request(self, n, addr):
+        # rx[:n] のクエリに対する応答を tx に組み立て、tx からそのまま送る
+        # 読む位置はすべて n と比べてから使い、壊れたパケットで例外にしない
+        data = self.rx
+        if n < 12 or data[2] & 0x80:
+            # ヘッダーに満たないものと、応答 (QR=1) には答えない
+            self.dropped += 1
             return
 
-        dns_id = data[0:2]
-        i = 12
-        while data[i] != 0:
-            i += 1 + data[i]
-        query = data[12:i+5]
-
-        response = dns_id
-        response += b"\x81\x80"
-        response += b"\x00\x01"
-        response += b"\x00\x01"
-        response += b"\x00\x00"
-        response += b"\x00\x00"
-        response += query
-
-        response += b"\xc0\x0c"
-        response += b"\x00\x01"
-        response += b"\x00\x01"
-        response += b"\x00\x00\x00\x3c"
-        response += b"\x00\x04"
-        response += bytes(map(int, self.ip.split('.')))
+        tx = self.tx_view
+        tx[0:2] = self.rx_view[0:2]
+        size = 12
+        if data[2] & 0x78:
+            # 標準の問い合わせ (OPCODE 0) 以外
+            tx[2:12] = _NOTIMP_HEADER
+            self.errors += 1
+        else:
+            name_end = skip_name(data, 12, n) if data[4] or data[5] else -1
+            end = name_end + 4
+            if name_end < 0 or end > n:
+                tx[2:12] = _FORMERR_HEADER
+                self.errors += 1
+            else:
+                qtype = data[name_end] << 8 | data[name_end + 1]
+                qclass = data[name_end + 2] << 8 | data[name_end + 3]
+                slot = self.names.hit(data, 12, name_end)
+                action = self.names.actions[slot] if slot >= 0 else ACTION_DEFAULT
+                if action == ACTION_NXDOMAIN:
+                    tx[2:12] = _NXDOMAIN_HEADER
+                    tail = self.soa
+                    self.nxdomain += 1
+                elif action == ACTION_DEFAULT and qclass == QCLASS_IN and qtype in (QTYPE_A, QTYPE_ANY):
+                    tx[2:12] = _ANSWER_HEADER
+                    tail = self.answer
+                    self.answered += 1
+                else:
+                    tx[2:12] = _NODATA_HEADER
+                    tail = self.soa
+                    self.nodata += 1
+                    if action == ACTION_DEFAULT:
+                        # 以前は型の違う A を返して再送させていた問い合わせ
+                        self.retries_saved += 1
+                # 質問は 1 つ目だけを返す
+                tx[12:end] = self.rx_view[12:end]
+                size = end + len(tail)
+                tx[end:size] = tail
 
         try:
-            self.sock.sendto(response, addr)
+            self.sock.sendto(tx[:size], addr)
         except Exception as e:
             print("send error:", e)
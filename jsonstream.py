@@ -0,0 +1,115 @@
+import ujson
+
+# 1 レコードの上限 (職務経歴 1 件の Markdown を想定)
+MAX_RECORD_SIZE = 16 * 1024
+
+_QUOTE = 0x22       # "
+_BACKSLASH = 0x5C   # \
+_OPEN = (0x5B, 0x7B)    # [ {
+_CLOSE = (0x5D, 0x7D)   # ] }
+_LBRACKET = 0x5B
+_LBRACE = 0x7B
+_SPACE = (0x20, 0x09, 0x0A, 0x0D, 0x2C)  # 空白と要素区切りの ,
+
+
+class JsonStreamSplitter:
+    """
+    リクエスト本文を少しずつ受け取り、完成した JSON レコードを 1 件ずつ on_record に渡す
+
+    expect_array=True: トップレベルの配列の各要素 (オブジェクト) を 1 件ずつ渡す
+    expect_array=False: トップレベルのオブジェクト全体を 1 件として渡す
+    全体を文字列にせず、1 レコード分だけをバッファに溜めてから ujson で解析する。
+    UTF-8 のマルチバイト文字は 0x80 以上なので、チャンク境界で分かれても構造の判定に影響しない。
+    不正な JSON は ValueError を送出する。
+    """
+
+    def __init__(self, on_record, expect_array=True, max_record=MAX_RECORD_SIZE):
+        self.on_record = on_record
+        self.expect_array = expect_array
+        self.max_record = max_record
+        self.record = bytearray()
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.done = False
+
+    def feed(self, data):
+        record_depth = 1 if self.expect_array else 0
+        # レコードが始まった位置。チャンク末尾で未完なら、ここから後ろを record に足す
+        start = 0 if self.depth > record_depth else -1
+        for i in range(len(data)):
+            c = data[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == _BACKSLASH:
+                    self.escape = True
+                elif c == _QUOTE:
+                    self.in_string = False
+                continue
+
+            if self.done and c not in _SPACE:
+                raise ValueError("trailing data")
+            if c in _OPEN:
+                if not self.started:
+                    if (c == _LBRACKET) != self.expect_array:
+                        raise ValueError("unexpected top-level value")
+                    self.started = True
+                if self.depth == record_depth:
+                    if c != _LBRACE:
+                        raise ValueError("record must be an object")
+                    start = i
+                self.depth += 1
+            elif c in _CLOSE:
+                if self.depth == 0:
+                    raise ValueError("unbalanced bracket")
+                self.depth -= 1
+                if self.depth == record_depth:
+                    self._append(data[start:i + 1])
+                    self._emit()
+                    start = -1
+                if self.depth == 0:
+                    self.done = True
+            elif c == _QUOTE:
+                if self.depth <= record_depth:
+                    raise ValueError("record must be an object")
+                self.in_string = True
+            elif c not in _SPACE and self.depth <= record_depth:
+                raise ValueError("unexpected value")
+
+        if start >= 0:
+            self._append(data[start:])
+
+    def close(self):
+        if not self.done or self.in_string:
+            raise ValueError("truncated JSON")
+
+    def _append(self, chunk):
+        if len(self.record) + len(chunk) > self.max_record:
+            raise ValueError("record too large")
+        self.record.extend(chunk)
+
+    def _emit(self):
+        record = ujson.loads(bytes(self.record))
+        self.record = bytearray()
+        self.on_record(record)
+
+
+def iter_json_array(records):
+    """
+    records (辞書のイテレーター) を JSON 配列の断片として 1 件ずつ bytes で返す
+    全件をリストにも 1 つの文字列にもしないので、メモリは 1 件分で済む
+    """
+    yield b"["
+    separator = b""
+    for record in records:
+        yield separator + ujson.dumps(record).encode()
+        separator = b","
+    yield b"]"
+
+
+def iter_ndjson(records):
+    """records を NDJSON (1 行に 1 件) として返す"""
+    for record in records:
+        yield ujson.dumps(record).encode() + b"\n"
@@ -4,10 +4,15 @@ from dns import DNSServer
 from storage import Storage
 from web import WebServer, RefuseHttpsServer
 from display import DisplayController
+from metrics import LoopMonitor
 
 import network
 import uasyncio as asyncio
 
+# イベントループの遅れを測り、/admin/metrics に出す (デバッグ用)。
+# 100 ms ごとに起きるタスクが増えるので、普段は止めておく
+LOOP_MONITOR = False
+
 
 # Wi-Fi AP setup
 ap = network.WLAN(network.AP_IF)
@@ -25,13 +30,15 @@ display_controller = DisplayController()
 # Initialize storage
 storage = Storage()
 
-# Initialize web server
-web_server = WebServer(storage, sta)
-refuse_server = RefuseHttpsServer()
-
 # Initialize dns server
 dns_server = DNSServer(ip=ap.ifconfig()[0])
 
+loop_monitor = LoopMonitor() if LOOP_MONITOR else None
+
+# Initialize web server
+web_server = WebServer(storage, sta, dns=dns_server, loop_monitor=loop_monitor)
+refuse_server = RefuseHttpsServer()
+
 
 async def main():
     ip = ap.ifconfig()[0]
@@ -40,12 +47,15 @@ async def main():
     display_controller.show_qr_code(ip, secrets.SSID, secrets.PASSWORD)
 
     # start servers and display cycle
-    await asyncio.gather(
+    tasks = [
         web_server.start(),
         refuse_server.start(),
         display_controller.start_display_cycle(),
         dns_server.start(),
-    )
+    ]
+    if loop_monitor:
+        tasks.append(loop_monitor.run())
+    await asyncio.gather(*tasks)
 
 # Run async main
 if __name__ == "__main__":
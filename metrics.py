@@ -0,0 +1,129 @@
+import gc
+import time
+import uasyncio as asyncio
+from array import array
+
+# レイテンシのバケット数。i 番目は 2^(i-1) ms 以上 2^i ms 未満 (最後は上限なし)
+LATENCY_BUCKETS = 14
+# ステータスの区分 (1xx - 5xx)
+STATUS_CLASSES = 5
+
+
+class Metrics:
+    """
+    ルートごとのリクエスト数・ステータス・転送量・レイテンシ・ヒープ使用量を集計する
+    値は起動時に確保した固定長の array に加算するだけなので、集計のたびに確保しない
+    """
+
+    def __init__(self, routes, counters=()):
+        self.routes = tuple(routes)
+        self.route_index = {name: i for i, name in enumerate(self.routes)}
+        self.counter_index = {name: i for i, name in enumerate(counters)}
+        self.counter_names = tuple(counters)
+        n = len(self.routes)
+        self.requests = array("L", [0] * n)
+        self.status = array("L", [0] * (n * STATUS_CLASSES))
+        self.bytes_in = array("L", [0] * n)
+        self.bytes_out = array("L", [0] * n)
+        self.latency = array("L", [0] * (n * LATENCY_BUCKETS))
+        self.latency_max_us = array("L", [0] * n)
+        self.free_min = array("L", [0xFFFFFFFF] * n)
+        self.alloc_growth_max = array("l", [0] * n)
+        self.counters = array("L", [0] * len(self.counter_names))
+
+    def count(self, name, n=1):
+        self.counters[self.counter_index[name]] += n
+
+    def record(self, route, status, bytes_in, bytes_out, elapsed_us, free_before, alloc_before):
+        i = self.route_index.get(route)
+        if i is None:
+            return
+        self.requests[i] += 1
+        if status:
+            cls = status // 100 - 1
+            if 0 <= cls < STATUS_CLASSES:
+                self.status[i * STATUS_CLASSES + cls] += 1
+        self.bytes_in[i] += bytes_in
+        self.bytes_out[i] += bytes_out
+
+        # ms 単位の 2 の累乗でバケットを決める
+        bucket = 0
+        ms = elapsed_us >> 10
+        while ms and bucket < LATENCY_BUCKETS - 1:
+            ms >>= 1
+            bucket += 1
+        self.latency[i * LATENCY_BUCKETS + bucket] += 1
+        if elapsed_us > self.latency_max_us[i]:
+            self.latency_max_us[i] = elapsed_us
+
+        free_after = gc.mem_free()
+        low = free_before if free_before < free_after else free_after
+        if low < self.free_min[i]:
+            self.free_min[i] = low
+        growth = gc.mem_alloc() - alloc_before
+        if growth > self.alloc_growth_max[i]:
+            self.alloc_growth_max[i] = growth
+
+    def report(self):
+        routes = {}
+        for i, name in enumerate(self.routes):
+            if not self.requests[i]:
+                continue
+            s = i * STATUS_CLASSES
+            b = i * LATENCY_BUCKETS
+            routes[name] = {
+                "requests": self.requests[i],
+                "status": {"{}xx".format(c + 1): self.status[s + c]
+                           for c in range(STATUS_CLASSES) if self.status[s + c]},
+                "bytes_in": self.bytes_in[i],
+                "bytes_out": self.bytes_out[i],
+                "latency_ms": list(self.latency[b:b + LATENCY_BUCKETS]),
+                "latency_max_us": self.latency_max_us[i],
+                "mem_free_min": self.free_min[i],
+                "mem_alloc_growth_max": self.alloc_growth_max[i],
+            }
+        return {
+            # latency_ms[i] の上限 (ms)。最後のバケットは上限なし
+            "latency_buckets_ms": [1 << i for i in range(LATENCY_BUCKETS - 1)],
+            "routes": routes,
+            "counters": {name: self.counters[i] for i, name in enumerate(self.counter_names)},
+            "mem_free": gc.mem_free(),
+            "mem_alloc": gc.mem_alloc(),
+        }
+
+
+# イベントループの遅れを測る間隔
+LOOP_PROBE_MS = 100
+
+
+class LoopMonitor:
+    """
+    一定間隔で眠り、予定より何 ms 遅れて起きたかを記録する (イベントループの詰まり具合の目安)
+    他のタスクが CPU を手放さないほど遅れが大きくなる
+    """
+
+    def __init__(self, interval_ms=LOOP_PROBE_MS):
+        self.interval_ms = interval_ms
+        self.samples = 0
+        self.lag_total_ms = 0
+        self.lag_max_ms = 0
+
+    async def run(self):
+        while True:
+            started = time.ticks_ms()
+            await asyncio.sleep_ms(self.interval_ms)
+            lag = time.ticks_diff(time.ticks_ms(), started) - self.interval_ms
+            if lag < 0:
+                lag = 0
+            self.samples += 1
+            self.lag_total_ms += lag
+            if lag > self.lag_max_ms:
+                self.lag_max_ms = lag
+
+    def report(self):
+        return {
+            "interval_ms": self.interval_ms,
+            "samples": self.samples,
+            "lag_avg_ms": self.lag_total_ms // self.samples if self.samples else 0,
+            "lag_max_ms": self.lag_max_ms,
+        }
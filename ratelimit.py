@@ -0,0 +1,71 @@
+import time
+from array import array
+
+# 覚えておく送信元の数 (超えたら最も長く使われていないものを入れ替える)
+RATE_LIMIT_CLIENTS = 8
+# 1 秒あたりに補充するトークンと、バケットの容量
+# 容量は端末の参加直後の接続確認と、ページ表示の連続したリクエストが収まる大きさにする
+RATE_LIMIT_PER_SEC = 10
+RATE_LIMIT_BURST = 40
+# 1 リクエストで使うトークン。保存やアップロードは重いので多めに取る
+COST_READ = 1
+COST_WRITE = 4
+
+# トークンは 1/1000 単位の整数で持ち、補充の計算で float を使わない
+_SCALE = 1000
+
+
+class RateLimiter:
+    """
+    送信元 IP アドレスごとのトークンバケット
+    表は固定長 (clients 件) で、起動時に確保した list と array を書き換えるだけ。
+    経過時間 (ms) x 毎秒の補充量 がそのまま 1/1000 単位の補充量になる。
+    """
+
+    def __init__(self, clients=RATE_LIMIT_CLIENTS, rate=RATE_LIMIT_PER_SEC, burst=RATE_LIMIT_BURST):
+        self.rate = rate
+        self.capacity = burst * _SCALE
+        self.addresses = [None] * clients
+        self.tokens = array("l", [0] * clients)
+        self.updated = array("l", [0] * clients)
+        self.limited = array("L", [0] * clients)
+
+    def _slot(self, address, now):
+        # 見つからなければ、空きか最も長く使われていない枠を満杯のバケットで割り当てる
+        oldest = 0
+        oldest_age = -1
+        for i in range(len(self.addresses)):
+            known = self.addresses[i]
+            if known == address:
+                return i
+            age = 0x7FFFFFFF if known is None else time.ticks_diff(now, self.updated[i])
+            if age > oldest_age:
+                oldest = i
+                oldest_age = age
+        self.addresses[oldest] = address
+        self.tokens[oldest] = self.capacity
+        self.updated[oldest] = now
+        self.limited[oldest] = 0
+        return oldest
+
+    def allow(self, address, cost=COST_READ):
+        now = time.ticks_ms()
+        i = self._slot(address, now)
+        elapsed = time.ticks_diff(now, self.updated[i])
+        self.updated[i] = now
+        tokens = self.tokens[i]
+        if elapsed > 0:
+            # 長く空いた場合に掛け算があふれないよう、満杯になる時間で打ち切る
+            refill = self.capacity if elapsed >= self.capacity // self.rate else elapsed * self.rate
+            tokens = min(self.capacity, tokens + refill)
+        cost *= _SCALE
+        if tokens < cost:
+            self.tokens[i] = tokens
+            self.limited[i] += 1
+            return False
+        self.tokens[i] = tokens - cost
+        return True
+
+    def report(self):
+        return [{"address": self.addresses[i], "tokens": self.tokens[i] // _SCALE, "limited": self.limited[i]}
+                for i in range(len(self.addresses)) if self.addresses[i] is not None]
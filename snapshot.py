@@ -0,0 +1,610 @@
+import uos
+import uasyncio as asyncio
+import logger
+
+SNAPSHOT_FILE = "/data/index.html"
+TEMPLATE_PATH = "/index.html"
+
+# index.html の中身を差し込む要素と、取り除くスクリプト
+# (Markdown はここで変換済み。変換できないものがあれば index.js が必要なときだけ読み込む)
+SECTION_IDS = ("user-info", "simplehist-info", "jobhist-info", "portrait-info")
+MARKED_SCRIPT = '<script src="/lib/marked.min.js"></script>'
+
+_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ('"', "&quot;"), ("'", "&#39;"))
+# インライン記法の開始文字 (h は http:// と https:// の自動リンク)
+_INLINE_MARKS = "`*_~[!<\\h"
+# バックスラッシュで文字として書ける記号
+_ESCAPABLE = "\\`*_{}[]()#+-.!|~<>\"'"
+_AUTOLINK_SCHEMES = ("http://", "https://")
+# 自動リンクの末尾に付いていても URL に含めない文字
+_URL_TRAILING = ".,:;!?\"'"
+
+
+def escape_html(text):
+    if not text:
+        return ""
+    for char, entity in _ESCAPES:
+        if char in text:
+            text = text.replace(char, entity)
+    return text
+
+
+_UNSAFE_SCHEMES = ("javascript:", "data:", "vbscript:")
+
+
+def _safe_url(url):
+    url = url.strip()
+    lower = url.lower()
+    for scheme in _UNSAFE_SCHEMES:
+        if lower.startswith(scheme):
+            return ""
+    return url
+
+
+def _is_word(c):
+    return c.isalpha() or c.isdigit()
+
+
+def _close_bracket(text, i):
+    # text[i] の "[" に対応する "]" の位置。なければ -1
+    depth = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+            if not depth:
+                return i
+        i += 1
+    return -1
+
+
+def _link_target(text, i):
+    """
+    text[i] の "(" から始まるリンク先を読み、(URL, タイトル, ")" の次の位置) を返す。閉じていなければ None
+    URL の中の括弧は対になっていれば含める ([x](http://host/Foo_(bar)) など)
+    """
+    depth = 0
+    n = len(text)
+    j = i
+    while j < n:
+        c = text[j]
+        if c == "\\":
+            j += 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if not depth:
+                break
+        j += 1
+    else:
+        return None
+    inner = text[i + 1:j].strip()
+    title = ""
+    if inner.startswith("<") and ">" in inner:
+        end = inner.index(">")
+        url = inner[1:end]
+        title = inner[end + 1:].strip()
+    else:
+        parts = inner.split(None, 1)
+        url = parts[0] if parts else ""
+        title = parts[1] if len(parts) > 1 else ""
+    if len(title) >= 2 and title[0] in "\"'(" and title[-1] in "\"')":
+        title = title[1:-1]
+    return url, title, j + 1
+
+
+def _autolink_end(text, i):
+    # text[i:] が http:// などで始まる URL なら、その終わりの位置。違えば -1
+    if i and _is_word(text[i - 1]):
+        return -1
+    for scheme in _AUTOLINK_SCHEMES:
+        if text.startswith(scheme, i):
+            break
+    else:
+        return -1
+    end = i + len(scheme)
+    n = len(text)
+    while end < n and not text[end].isspace() and text[end] != "<":
+        end += 1
+    # 文末の句読点と、対になっていない閉じ括弧は URL に含めない
+    while end > i + len(scheme):
+        c = text[end - 1]
+        if c in _URL_TRAILING or (c == ")" and text.count("(", i, end) < text.count(")", i, end)):
+            end -= 1
+        else:
+            break
+    return end if end > i + len(scheme) else -1
+
+
+def _emphasis(text, i, mark):
+    # text[i:] の強調の (タグ, 中身の開始, 中身の終わり, 閉じの次の位置)。強調でなければ None
+    n = len(text)
+    double = text.startswith(mark * 2, i)
+    size = 2 if double else 1
+    start = i + size
+    if start >= n or text[start].isspace():
+        return None
+    # _ は単語の途中 (snake_case など) では強調にしない
+    if mark == "_" and i and _is_word(text[i - 1]):
+        return None
+    end = text.find(mark * size, start + 1 if size == 1 else start)
+    while end > 0:
+        after = end + size
+        if not text[end - 1].isspace() and not (mark == "_" and after < n and _is_word(text[after])) \
+                and not (size == 1 and text.startswith(mark * 2, end)):
+            return ("strong" if double else "em"), start, end, after
+        end = text.find(mark * size, end + size)
+    return None
+
+
+def render_inline(text):
+    """
+    コード `x`、強調 **x** / __x__ / *x* / _x_、打ち消し ~~x~~、リンク [x](url "title")、画像 ![alt](src)、
+    自動リンク <http://...> と http://...、バックスラッシュのエスケープを扱う
+    """
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        # 記法の文字まではまとめてエスケープする
+        j = i
+        while j < n and text[j] not in _INLINE_MARKS:
+            j += 1
+        if j > i:
+            out.append(escape_html(text[i:j]))
+            i = j
+            if i >= n:
+                break
+        c = text[i]
+        if c == "\\":
+            if i + 1 < n and text[i + 1] in _ESCAPABLE:
+                out.append(escape_html(text[i + 1]))
+                i += 2
+                continue
+        elif c == "`":
+            # 開きと同じ数のバッククォートで閉じる
+            ticks = 1
+            while i + ticks < n and text[i + ticks] == "`":
+                ticks += 1
+            end = text.find("`" * ticks, i + ticks)
+            if end > 0:
+                out.append("<code>" + escape_html(text[i + ticks:end].strip()) + "</code>")
+                i = end + ticks
+                continue
+            out.append("`" * ticks)
+            i += ticks
+            continue
+        elif c == "*" or c == "_":
+            found = _emphasis(text, i, c)
+            if found:
+                tag, start, end, after = found
+                out.append("<" + tag + ">" + render_inline(text[start:end]) + "</" + tag + ">")
+                i = after
+                continue
+        elif c == "~":
+            if text.startswith("~~", i):
+                end = text.find("~~", i + 2)
+                if end > i + 2:
+                    out.append("<del>" + render_inline(text[i + 2:end]) + "</del>")
+                    i = end + 2
+                    continue
+        elif c == "[" or (c == "!" and text.startswith("![", i)):
+            image = c == "!"
+            open_at = i + 1 if image else i
+            close = _close_bracket(text, open_at)
+            target = _link_target(text, close + 1) if close > 0 and text.startswith("(", close + 1) else None
+            if target:
+                url, title, after = target
+                title_attr = ' title="' + escape_html(title) + '"' if title else ""
+                href = escape_html(_safe_url(url))
+                if image:
+                    out.append('<img src="' + href + '" alt="' + escape_html(text[open_at + 1:close]) + '"'
+                               + title_attr + ">")
+                else:
+                    out.append('<a href="' + href + '"' + title_attr + ">"
+                               + render_inline(text[open_at + 1:close]) + "</a>")
+                i = after
+                continue
+        elif c == "<":
+            end = text.find(">", i + 1)
+            if end > 0 and _autolink_end(text[:end], i + 1) == end:
+                url = escape_html(text[i + 1:end])
+                out.append('<a href="' + url + '">' + url + "</a>")
+                i = end + 1
+                continue
+        elif c == "h":
+            end = _autolink_end(text, i)
+            if end > 0:
+                url = escape_html(text[i:end])
+                out.append('<a href="' + url + '">' + url + "</a>")
+                i = end
+                continue
+        out.append(escape_html(c))
+        i += 1
+    return "".join(out)
+
+
+def _list_item(line):
+    # 箇条書きなら (タグ, 本文, 番号) を返す
+    if line[:2] in ("- ", "* ", "+ "):
+        return "ul", line[2:], 1
+    digits = 0
+    while digits < len(line) and "0" <= line[digits] <= "9":
+        digits += 1
+    if digits and line[digits:digits + 2] in (". ", ") "):
+        return "ol", line[digits + 2:], int(line[:digits])
+    return None, None, None
+
+
+def _is_rule(line):
+    # --- / *** / ___ (間の空白は無視)
+    chars = line.replace(" ", "")
+    return len(chars) >= 3 and chars[0] in "-*_" and chars == chars[0] * len(chars)
+
+
+def _table_cells(line):
+    # 表の 1 行をセルに分ける。前後の | は省略でき、\| はセルの区切りにしない
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    cells = []
+    start = 0
+    i = 0
+    while i < len(line):
+        if line[i] == "\\":
+            i += 1
+        elif line[i] == "|":
+            cells.append(line[start:i].strip().replace("\\|", "|"))
+            start = i + 1
+        i += 1
+    cells.append(line[start:].strip().replace("\\|", "|"))
+    return cells
+
+
+def _table_aligns(line):
+    # 見出しと本文の区切り行 (|:--|--:|) なら列ごとの寄せ方、違えば None
+    if "-" not in line:
+        return None
+    aligns = []
+    for cell in _table_cells(line):
+        core = cell.strip(":")
+        if not core or core != "-" * len(core):
+            return None
+        if cell.startswith(":") and cell.endswith(":"):
+            aligns.append("center")
+        elif cell.endswith(":"):
+            aligns.append("right")
+        elif cell.startswith(":"):
+            aligns.append("left")
+        else:
+            aligns.append(None)
+    return aligns
+
+
+def _write_row(write, tag, cells, aligns):
+    write("<tr>\n")
+    for k, align in enumerate(aligns):
+        cell = cells[k] if k < len(cells) else ""
+        attr = ' align="' + align + '"' if align else ""
+        write("<" + tag + attr + ">" + render_inline(cell) + "</" + tag + ">\n")
+    write("</tr>\n")
+
+
+def _write_paragraph(write, lines):
+    # 末尾の 2 つ以上の空白かバックスラッシュは改行 (<br>)
+    write("<p>")
+    last = len(lines) - 1
+    for k, line in enumerate(lines):
+        text = line.rstrip()
+        hard = k < last and (line.endswith("  ") or text.endswith("\\"))
+        if hard and text.endswith("\\"):
+            text = text[:-1]
+        write(render_inline(text.strip()))
+        if k < last:
+            write("<br>" if hard else "\n")
+    write("</p>\n")
+
+
+def _is_block_start(stripped):
+    return (stripped.startswith("#") or stripped.startswith("```") or stripped.startswith(">")
+            or _is_rule(stripped) or _list_item(stripped)[0] is not None)
+
+
+def markdown_supported(text):
+    """
+    render_markdown で marked と同じ見た目にできるか
+    入れ子の箇条書き・インデントのコードブロック・参照形式のリンク・生の HTML・チェックボックス・
+    www. の自動リンクは扱わないので False (ブラウザの marked に任せる)
+    """
+    if not text:
+        return True
+    in_code = False
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code = not in_code
+            continue
+        if in_code or not stripped:
+            continue
+        indent = len(line) - len(line.lstrip())
+        tag, item, _ = _list_item(stripped)
+        if indent >= 4 or (indent >= 2 and tag):
+            return False
+        if tag and item[:4] in ("[ ] ", "[x] ", "[X] "):
+            return False
+        if stripped.startswith("[") and ("]:" in stripped or stripped.startswith("[^")):
+            return False
+        if "][" in stripped or "[^" in stripped or "www." in stripped:
+            return False
+        i = stripped.find("<")
+        while i >= 0:
+            c = stripped[i + 1:i + 2]
+            if c and (c.isalpha() or c in "/!?") and _autolink_end(stripped, i + 1) < 0:
+                return False
+            i = stripped.find("<", i + 1)
+    return True
+
+
+def render_markdown(text, write):
+    """
+    index.js の marked.parse の代わりに、よく使う Markdown を HTML にして write に渡す
+    見出し (# と下線)・箇条書き (番号付きを含む)・コードブロック・引用・表・区切り線・段落とインライン記法に対応する。
+    生の HTML はそのまま通さずエスケープする。
+    """
+    if not text:
+        return
+    lines = text.split("\n")
+    paragraph = []
+    list_tag = None
+    in_code = False
+    i = 0
+    n = len(lines)
+    while i < n:
+        line = lines[i]
+        i += 1
+        stripped = line.strip()
+        if in_code:
+            if stripped.startswith("```"):
+                write("</code></pre>\n")
+                in_code = False
+            else:
+                write(escape_html(line) + "\n")
+            continue
+
+        # 段落の直後の === / --- は、その段落を見出しにする
+        if paragraph and stripped and (stripped == "=" * len(stripped) or stripped == "-" * len(stripped)):
+            level = 1 if stripped[0] == "=" else 2
+            write("<h{0}>{1}</h{0}>\n".format(level, render_inline(" ".join(p.strip() for p in paragraph))))
+            paragraph = []
+            continue
+
+        rule = _is_rule(stripped)
+        tag, item, number = (None, None, None) if rule else _list_item(stripped)
+        level = 0
+        while level < len(stripped) and stripped[level] == "#":
+            level += 1
+        is_heading = 0 < level <= 6 and (stripped[level:level + 1] == " " or level == len(stripped))
+        aligns = None
+        if "|" in stripped and i < n:
+            aligns = _table_aligns(lines[i].strip())
+            if aligns is not None and len(aligns) != len(_table_cells(stripped)):
+                aligns = None
+        block = not stripped or tag or is_heading or rule or aligns is not None
+        block = block or stripped.startswith("```") or stripped.startswith(">")
+        if paragraph and block:
+            _write_paragraph(write, paragraph)
+            paragraph = []
+        if list_tag and tag != list_tag:
+            write("</" + list_tag + ">\n")
+            list_tag = None
+
+        if not stripped:
+            continue
+        if stripped.startswith("```"):
+            write("<pre><code>")
+            in_code = True
+        elif is_heading:
+            write("<h{0}>{1}</h{0}>\n".format(level, render_inline(stripped[level:].strip().rstrip("#").strip())))
+        elif rule:
+            write("<hr>\n")
+        elif aligns is not None:
+            write("<table>\n<thead>\n")
+            _write_row(write, "th", _table_cells(stripped), aligns)
+            write("</thead>\n")
+            i += 1
+            body = False
+            while i < n and lines[i].strip() and not _is_block_start(lines[i].strip()):
+                if not body:
+                    write("<tbody>\n")
+                    body = True
+                _write_row(write, "td", _table_cells(lines[i]), aligns)
+                i += 1
+            if body:
+                write("</tbody>\n")
+            write("</table>\n")
+        elif stripped.startswith(">"):
+            # 続く > の行をまとめ、中身を Markdown として描画する
+            quoted = [stripped[1:]]
+            while i < n and lines[i].strip().startswith(">"):
+                quoted.append(lines[i].strip()[1:])
+                i += 1
+            write("<blockquote>\n")
+            render_markdown("\n".join(q[1:] if q.startswith(" ") else q for q in quoted), write)
+            write("</blockquote>\n")
+        elif tag:
+            if not list_tag:
+                write("<" + tag + (' start="{}"'.format(number) if tag == "ol" and number != 1 else "") + ">\n")
+                list_tag = tag
+            write("<li>" + render_inline(item) + "</li>\n")
+        else:
+            paragraph.append(line)
+
+    if in_code:
+        write("</code></pre>\n")
+    if paragraph:
+        _write_paragraph(write, paragraph)
+    if list_tag:
+        write("</" + list_tag + ">\n")
+
+
+def write_markdown(text, write):
+    # 扱えない記法を含むものは元の Markdown のまま埋め込み、ブラウザで marked が描画する (index.js)
+    if markdown_supported(text):
+        render_markdown(text, write)
+    else:
+        write('<div data-markdown="1">' + escape_html(text) + "</div>")
+
+
+class Snapshot:
+    """
+    公開ページ (index.html) に履歴書のデータを埋め込んだ静的な HTML を作る
+
+    Storage の保存のたびに作り直すので、/ はこのファイルを返すだけで済み、
+    ブラウザは API の呼び出しも Markdown の解析もしない。
+    ユーザー情報が空の場合や作成に失敗した場合はファイルを消し、従来の index.html に任せる。
+    作り直しは保存の応答を返した後にタスクで行い、セクションとレコードの間で他のタスクに順番を譲る。
+    作り直している間はファイルを消しておき、古い内容を返さない。
+    """
+
+    def __init__(self, storage, assets, path=SNAPSHOT_FILE):
+        self.storage = storage
+        self.assets = assets
+        self.path = path
+        # dirty: 作り直しが必要か、rendering: 作り直しのタスクが動いているか
+        self.dirty = False
+        self.rendering = False
+
+    def on_storage_write(self, section):
+        self.schedule()
+
+    def schedule(self):
+        self._remove(self.path)
+        self.dirty = True
+        if not self.rendering:
+            self.rendering = True
+            asyncio.create_task(self._render_task())
+
+    async def _render_task(self):
+        # 作っている間に保存されたら、終わってからもう一度作る
+        try:
+            while self.dirty:
+                self.dirty = False
+                await self.render()
+        finally:
+            self.rendering = False
+
+    async def render(self):
+        user = self.storage.read_user()
+        if not user:
+            self._remove(self.path)
+            return False
+        temp_path = self.path + ".tmp"
+        try:
+            template = self._load_template()
+            with open(temp_path, "w") as out:
+                await self._write_page(out.write, template, user)
+            if self.dirty:
+                # 作っている間に保存された分は含まれていないかもしれないので、次の作り直しに任せる
+                self._remove(temp_path)
+                return False
+            self._remove(self.path)
+            uos.rename(temp_path, self.path)
+            return True
+        except (OSError, MemoryError, ValueError) as error:
+            logger.error("Snapshot render error: {}".format(error))
+            self._remove(temp_path)
+            self._remove(self.path)
+            return False
+
+    def _load_template(self):
+        template = self.assets.read(TEMPLATE_PATH)
+        if template is None:
+            with open("www" + TEMPLATE_PATH, "rb") as f:
+                template = f.read()
+        return template.decode()
+
+    async def _write_page(self, write, template, user):
+        template = template.replace(MARKED_SCRIPT, "").replace("<body>", '<body data-snapshot="1">', 1)
+        renderers = (self._write_user, self._write_simplehist, self._write_jobhist, self._write_portrait)
+        pos = 0
+        for section_id, render in zip(SECTION_IDS, renderers):
+            marker = 'id="{}">'.format(section_id)
+            i = template.find(marker, pos)
+            if i < 0:
+                raise ValueError("template has no #" + section_id)
+            i += len(marker)
+            write(template[pos:i])
+            await render(write, user)
+            await asyncio.sleep_ms(0)
+            pos = i
+        write(template[pos:])
+
+    async def _write_user(self, write, user):
+        # index.js のプロフィール部分と同じ構造で出力する
+        e = escape_html
+        write('<div class="profile-top"><div class="user-image">'
+              '<img src="/image.jpg" alt="User" loading="lazy"></div><dl>')
+        write('<div class="field field-name"><dt>名前</dt><dd class="user-name">'
+              + e(user.get("usr_name")) + " (" + e(user.get("usr_name_kana")) + ")</dd></div>")
+        write('<div class="field field-address"><dt>住所</dt><dd>' + e(user.get("usr_addr")) + "</dd></div></dl>")
+        write('<dl class="personal-block personal-contacts">')
+        write('<div class="field"><dt>電話番号</dt><dd>' + e(user.get("usr_phone") or "なし") + "</dd></div>")
+        write('<div class="field"><dt>携帯番号</dt><dd>' + e(user.get("usr_mobile")) + "</dd></div>")
+        write('<div class="field field-email"><dt>E メール</dt><dd>' + e(user.get("usr_email")) + "</dd></div></dl>")
+        write('<dl class="personal-block personal-demographics">')
+        write('<div class="field"><dt>生年月日</dt><dd>' + e(user.get("usr_birthday")) + "</dd></div>")
+        write('<div class="field"><dt>年齢</dt><dd>満' + e(user.get("usr_age")) + "歳</dd></div>")
+        write('<div class="field"><dt>性別</dt><dd>' + ("女" if user.get("usr_gender") == "1" else "男") + "</dd></div>")
+        write('<div class="field"><dt>扶養家族</dt><dd>'
+              + ("あり" if user.get("usr_family") == "1" else "なし") + "</dd></div>")
+        write("</dl></div><dl>")
+        write('<div class="field-block field-licenses"><dt>免許・資格</dt><dd>'
+              + e(user.get("usr_licenses")).replace("\n", "<br>") + "</dd></div>")
+        for css, label, key in (("field-skill", "特技", "usr_skill"),
+                                ("field-motivation", "志望動機", "usr_siboudouki")):
+            write('<div class="field-block ' + css + '"><dt>' + label + "</dt><dd>")
+            write_markdown(user.get(key), write)
+            write("</dd></div>")
+        write('<div class="field-block field-access"><dt>通勤時間</dt><dd>' + e(user.get("usr_access")) + "</dd></div>")
+        write('<div class="field-block field-hobby"><dt>趣味</dt><dd>')
+        write_markdown(user.get("usr_hobby"), write)
+        write("</dd></div></dl>")
+
+    async def _write_simplehist(self, write, user):
+        write('<ul class="history-list">')
+        for h in self.storage.iter_records("simplehist"):
+            write('<li class="history-item">' + escape_html(h["hist_datetime"]) + " "
+                  + escape_html(h["hist_status"]) + ": " + escape_html(h["hist_name"]) + "</li>")
+            await asyncio.sleep_ms(0)
+        write("</ul>")
+
+    async def _write_jobhist(self, write, user):
+        for j in self.storage.iter_records("jobhist"):
+            write('<div class="job-entry"><h4 class="job-title">' + escape_html(j["job_name"])
+                  + '</h4><div class="job-detail">')
+            write_markdown(j["job_description"], write)
+            write("</div></div>")
+            await asyncio.sleep_ms(0)
+
+    async def _write_portrait(self, write, user):
+        for p in self.storage.iter_records("portrait"):
+            url = escape_html(p["portrait_url"])
+            write('<div class="portrait-item"><h5 class="portrait-title"><a target="_blank" href="'
+                  + escape_html(_safe_url(p["portrait_url"])) + '">' + url + '</a></h5><div class="portrait-body">')
+            write_markdown(p["portrait_summary"], write)
+            write("</div></div>")
+            await asyncio.sleep_ms(0)
+
+    def _remove(self, path):
+        try:
+            uos.remove(path)
+        except OSError:
+            pass
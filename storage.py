@@ -1,5 +1,53 @@
 import uos
-import gc
+import ubinascii
+
+
+class RecordWriter:
+    """
+    レコードを 1 件ずつ一時ファイルに書き、commit で本来のファイルと置き換える
+    リクエスト本文を全件メモリに載せずに保存するために使う
+    """
+
+    def __init__(self, storage, section):
+        self.storage = storage
+        self.section = section
+        self.filepath, self.format_line, self.keep_if_empty = storage.sections[section]
+        # 同じファイルへの同時保存で一時ファイルが衝突しないよう連番を付ける
+        storage.write_seq += 1
+        self.temp_path = "{}.{}.tmp".format(self.filepath, storage.write_seq)
+        self.file = open(self.temp_path, "w")
+        self.count = 0
+
+    def write(self, entry):
+        if self.count:
+            self.file.write("\n")
+        self.file.write(self.format_line(entry))
+        self.count += 1
+
+    def commit(self):
+        self.file.close()
+        if self.count == 0 and self.keep_if_empty:
+            self._remove_temp()
+            return
+        try:
+            uos.remove(self.filepath)
+        except OSError:
+            pass
+        uos.rename(self.temp_path, self.filepath)
+        self.storage._touch(self.section)
+
+    def abort(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self._remove_temp()
+
+    def _remove_temp(self):
+        try:
+            uos.remove(self.temp_path)
+        except OSError:
+            pass
 
 
 class Storage:
@@ -11,6 +59,13 @@ class Storage:
         "usr_siboudouki", "usr_hobby", "usr_skill", "usr_access"
     ]
 
+    # CSV のセクションごとのフィールド名
+    CSV_FIELDS = {
+        "simplehist": ("hist_no", "hist_datetime", "hist_status", "hist_name"),
+        "jobhist": ("job_no", "job_name", "job_description"),
+        "portrait": ("portrait_no", "portrait_url", "portrait_summary"),
+    }
+
     # 改行をBRタグに置換するキーのセット
     KEYS_TO_REPLACE = {"usr_licenses",
                        "usr_siboudouki", "usr_hobby", "usr_skill"}
@@ -21,11 +76,50 @@ class Storage:
         self.simplehist_file = f"{self.data_dir}/simplehist.csv"
         self.jobhist_file = f"{self.data_dir}/jobhist.csv"
         self.portrait_file = f"{self.data_dir}/portrait.csv"
+        # write_* のたびに進める世代番号。ETag に使い、起動ごとに boot_id で区別する
+        self.generations = {"user": 0, "simplehist": 0,
+                            "jobhist": 0, "portrait": 0}
+        self.boot_id = ubinascii.hexlify(uos.urandom(4)).decode()
+        # セクション名: (ファイル, 1 レコードを CSV 1 行にする関数, 0 件なら既存を残すか)
+        self.sections = {
+            "user": (self.user_file, self._user_line, False),
+            "simplehist": (self.simplehist_file, self._simplehist_line, False),
+            "jobhist": (self.jobhist_file, self._jobhist_line, True),
+            "portrait": (self.portrait_file, self._portrait_line, False),
+        }
+        self.write_seq = 0
+        # 保存のたびに section 名を渡して呼ぶ関数 (add_listener で登録)
+        self.listeners = []
         try:
             uos.mkdir(self.data_dir)
         except OSError:
             pass
 
+    def etag(self, *sections):
+        gens = "-".join(str(self.generations[name]) for name in sections)
+        return '"{}-{}"'.format(self.boot_id, gens)
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    def _touch(self, section):
+        self.generations[section] += 1
+        for func in self.listeners:
+            func(section)
+
+    def open_writer(self, section):
+        return RecordWriter(self, section)
+
+    def _write_records(self, section, records):
+        writer = self.open_writer(section)
+        try:
+            for entry in records:
+                writer.write(entry)
+        except Exception:
+            writer.abort()
+            raise
+        writer.commit()
+
     def read_user(self):
         try:
             with open(self.user_file, "r") as f:
@@ -40,38 +134,51 @@ class Storage:
             return {}
 
     def write_user(self, data):
+        self._write_records("user", (data,))
+
+    def _user_line(self, data):
         values = [self._sanitize_value(key, data.get(key, ""))
                   for key in self.USER_KEYS]
         # user.csv の各フィールドからカンマを除去（または置換）
         safe_values = [v.replace(",", "、") for v in values]
-        self._safe_write_lines(self.user_file, [",".join(safe_values)])
+        return ",".join(safe_values)
 
     def read_simplehist(self):
-        return self._read_csv_with_fields(
-            self.simplehist_file,
-            ("hist_no", "hist_datetime", "hist_status", "hist_name")
-        )
+        return list(self.iter_simplehist())
+
+    def iter_simplehist(self):
+        return self.iter_records("simplehist")
 
     def write_simplehist(self, data):
-        lines = []
-        for entry in data:
-            # カンマを置換してCSV構造を保護
-            datetime = str(entry['hist_datetime']).replace(",", "、")
-            status = str(entry['hist_status']).replace(",", "、")
-            name = str(entry['hist_name']).replace(",", "、")
-            lines.append(f"{entry['hist_no']},{datetime},{status},{name}")
-        
-        gc.collect()
-        self._safe_write_lines(self.simplehist_file, lines)
-
-    def _read_csv_with_fields(self, filepath, field_names):
+        self._write_records("simplehist", data)
+
+    def _simplehist_line(self, entry):
+        # カンマを置換してCSV構造を保護
+        datetime = str(entry['hist_datetime']).replace(",", "、")
+        status = str(entry['hist_status']).replace(",", "、")
+        name = str(entry['hist_name']).replace(",", "、")
+        return f"{entry['hist_no']},{datetime},{status},{name}"
+
+    def file_size(self, section):
+        try:
+            return uos.stat(self.sections[section][0])[6]
+        except OSError:
+            return 0
+
+    def iter_records(self, section):
+        """
+        CSV のセクションを 1 行ずつ辞書にして返すジェネレーター
+        全件をリストにしないため、件数が多くてもメモリは 1 件分で済む
+        """
+        return self._iter_csv_with_fields(self.sections[section][0], self.CSV_FIELDS[section])
+
+    def _iter_csv_with_fields(self, filepath, field_names):
         """
         CSV ファイルを読み込む共通メソッド
         field_names: フィールド名のタプル (例: ("job_no", "job_name", "job_description"))
         """
         try:
             with open(filepath, "r") as file:
-                result = []
                 while True:
                     line = file.readline()
                     if not line:
@@ -93,70 +200,41 @@ class Storage:
                                     entry[field] = val
                             else:
                                 entry[field] = ""
-                        result.append(entry)
+                        yield entry
                     del line
-                return result
         except OSError:
-            return []
+            return
 
     def read_jobhist(self):
-        return self._read_csv_with_fields(
-            self.jobhist_file,
-            ("job_no", "job_name", "job_description")
-        )
+        return list(self.iter_jobhist())
 
-    def write_jobhist(self, data):
-        if not data:
-            return
+    def iter_jobhist(self):
+        return self.iter_records("jobhist")
 
-        def iter_lines():
-            for entry in data:
-                job_no = entry.get("job_no", 0)
-                job_name = str(entry.get("job_name", "")).replace(",", "、")
-                desc = str(entry.get("job_description", "")).replace(
-                    "\n", "<br>").replace(",", "、")
-                yield "{},{},{}".format(job_no, job_name, desc)
+    def write_jobhist(self, data):
+        # 0 件の場合は既存の職務経歴を残す
+        self._write_records("jobhist", data or ())
 
-        gc.collect()
-        self._safe_write_lines(self.jobhist_file, iter_lines())
+    def _jobhist_line(self, entry):
+        job_no = entry.get("job_no", 0)
+        job_name = str(entry.get("job_name", "")).replace(",", "、")
+        desc = str(entry.get("job_description", "")).replace(
+            "\n", "<br>").replace(",", "、")
+        return "{},{},{}".format(job_no, job_name, desc)
 
     def read_portrait(self):
-        return self._read_csv_with_fields(
-            self.portrait_file,
-            ("portrait_no", "portrait_url", "portrait_summary")
-        )
+        return list(self.iter_portrait())
+
+    def iter_portrait(self):
+        return self.iter_records("portrait")
 
     def write_portrait(self, data):
-        lines = []
-        for entry in data:
-            url = str(entry['portrait_url']).replace(",", "、")
-            summary = str(entry['portrait_summary']).replace("\n", "<br>").replace(",", "、")
-            lines.append(f"{entry['portrait_no']},{url},{summary}")
-        
-        gc.collect()
-        self._safe_write_lines(self.portrait_file, lines)
-
-    def _safe_write_lines(self, filepath, lines):
-        temp_path = filepath + ".tmp"
-        try:
-            with open(temp_path, "w") as file:
-                first = True
-                for line in lines:
-                    if not first:
-                        file.write("\n")
-                    file.write(line)
-                    first = False
-            try:
-                uos.remove(filepath)
-            except OSError:
-                pass
-            uos.rename(temp_path, filepath)
-        except Exception:
-            try:
-                uos.remove(temp_path)
-            except OSError:
-                pass
-            raise
+        self._write_records("portrait", data)
+
+    def _portrait_line(self, entry):
+        url = str(entry['portrait_url']).replace(",", "、")
+        summary = str(entry['portrait_summary']).replace("\n", "<br>").replace(",", "、")
+        return f"{entry['portrait_no']},{url},{summary}"
 
     def _sanitize_value(self, key, value):
         if value is None:
@@ -0,0 +1,73 @@
+"""
+DNS サーバー (dns.py) の 1 秒あたりの応答数を測るホスト側スクリプト
+
+Pico の AP に接続した PC から実行し、同時に --window 件までのクエリを送り続けて
+--duration 秒間に返ってきた応答を数える。応答のない分は --timeout 秒で諦めて次を送る。
+
+    python3 tools/bench_dns.py                       # 192.168.4.1:53 に 5 秒間
+    python3 tools/bench_dns.py --window 8 --duration 10
+"""
+import argparse
+import socket
+import struct
+import time
+
+DEFAULT_NAMES = ("connectivitycheck.gstatic.com", "captive.apple.com", "www.msftconnecttest.com")
+
+
+def build_query(qid, name, qtype=1):
+    packet = struct.pack(">HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+    for label in name.split("."):
+        packet += bytes([len(label)]) + label.encode()
+    return packet + b"\0" + struct.pack(">HH", qtype, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--server", default="192.168.4.1", help="DNS server address (default: 192.168.4.1)")
+    parser.add_argument("--port", type=int, default=53, help="DNS server port (default: 53)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to run (default: 5)")
+    parser.add_argument("--window", type=int, default=4, help="queries in flight (default: 4)")
+    parser.add_argument("--timeout", type=float, default=0.5, help="seconds before a query counts as lost")
+    parser.add_argument("--qtype", type=int, default=1, help="query type (1=A, 28=AAAA, 65=HTTPS)")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(args.timeout)
+    server = (args.server, args.port)
+    queries = [build_query(i, DEFAULT_NAMES[i % len(DEFAULT_NAMES)], args.qtype) for i in range(256)]
+
+    sent = answered = lost = 0
+    latencies = []
+    in_flight = {}
+    started = time.perf_counter()
+    deadline = started + args.duration
+    while time.perf_counter() < deadline:
+        while len(in_flight) < args.window:
+            qid = sent % len(queries)
+            sock.sendto(queries[qid], server)
+            in_flight[qid] = time.perf_counter()
+            sent += 1
+        try:
+            reply = sock.recv(512)
+        except socket.timeout:
+            # 返ってこなかった分は捨てて送り直す
+            lost += len(in_flight)
+            in_flight.clear()
+            continue
+        sent_at = in_flight.pop(struct.unpack(">H", reply[:2])[0], None)
+        if sent_at is not None:
+            answered += 1
+            latencies.append(time.perf_counter() - sent_at)
+    elapsed = time.perf_counter() - started
+
+    print("sent {}  answered {}  lost {}  in {:.1f} s".format(sent, answered, lost, elapsed))
+    if answered:
+        latencies.sort()
+        print("{:.0f} queries/s  latency p50 {:.1f} ms  p99 {:.1f} ms".format(
+            answered / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000))
+
+
+if __name__ == "__main__":
+    main()
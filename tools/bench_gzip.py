@@ -0,0 +1,126 @@
+"""
+/api の JSON を compress.GzipEncoder で流しながら圧縮したときの、CPU 時間と転送時間を比べるホスト側スクリプト
+
+web.py と同じく 1 レコードずつ (iter_json_array と同じ断片で) 圧縮し、窓の大きさ (wbits) ごとに
+圧縮後の大きさ・CPU 時間・指定した回線速度での転送時間を表にする。
+ホストでは GzipEncoder は zlib.compressobj を使うので、ここで測るのは zlib の時間で、実機の deflate.DeflateIO
+ではない。圧縮後の大きさは目安になるが、CPU 時間は実機で同じ JSON を圧縮して測った比率を --cpu-scale に
+渡して見積もる (既定の 1 はホストの値そのまま)。
+
+    python3 tools/bench_gzip.py                          # 職務経歴風のサンプルで測る
+    python3 tools/bench_gzip.py --json jobhist.json      # 実機の /api/jobhist を保存したもので測る
+    python3 tools/bench_gzip.py --kbps 500 --cpu-scale 40
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from compress import GzipEncoder, COMPRESS_MIN_WBITS  # noqa: E402
+
+# zlib の窓の上限 (deflate.DeflateIO も同じ)
+MAX_WBITS = 15
+
+# サンプルの本文はこれらの行を乱数で組み合わせて作る。同じ文の繰り返しばかりだと実際より縮んでしまう
+SAMPLE_TASKS = (
+    "組み込み機器のファームウェア開発 (**C** / MicroPython)",
+    "製造ラインの検査装置の保守と改善",
+    "社内向けの Web 管理画面の設計と実装",
+    "センサーデータ収集基盤の構築 (Python / PostgreSQL)",
+    "協力会社との仕様調整と受け入れ試験",
+    "新人向けの開発環境の整備と勉強会の運営",
+    "既存システムのクラウド移行 (AWS)",
+    "顧客向けの障害対応と原因調査の報告書作成",
+    "基板評価用の治具ソフトウェアの開発",
+    "生産計画システムの帳票改修",
+)
+SAMPLE_NOTES = (
+    "`Pico W` 上で動く軽量な HTTP サーバーを実装した。",
+    "不良率を前年比で {}% 削減した。",
+    "{} 名のチームでリーダーを務めた。",
+    "詳細は [ポートフォリオ](https://example.com/{}) を参照。",
+    "{} 年に社内表彰を受けた。",
+    "応答時間を平均 {} ms 短縮した。",
+)
+
+
+def sample_description(rng):
+    lines = ["## 担当業務"]
+    for task in rng.sample(SAMPLE_TASKS, rng.randint(2, 5)):
+        lines.append("- " + task)
+    lines.append("")
+    for note in rng.sample(SAMPLE_NOTES, rng.randint(1, 3)):
+        lines.append(note.format(rng.randint(2, 2024)))
+    return "\n".join(lines) + "\n"
+
+
+def sample_records(count):
+    rng = random.Random(count)
+    return [{"job_no": i + 1, "job_name": "株式会社サンプル 第{}開発部".format(rng.randint(1, 20)),
+             "job_start": "{}-{:02d}".format(rng.randint(2005, 2024), rng.randint(1, 12)),
+             "job_description": sample_description(rng)} for i in range(count)]
+
+
+def iter_chunks(records):
+    # jsonstream.iter_json_array と同じ区切りで断片を作る
+    yield b"["
+    separator = b""
+    for record in records:
+        # MicroPython の json と同じく、日本語はエスケープせずに UTF-8 で出す
+        yield separator + json.dumps(record, ensure_ascii=False).encode()
+        separator = b","
+    yield b"]"
+
+
+def measure(chunks, wbits, repeat):
+    # 戻り値: (圧縮後のバイト数, 1 回あたりの CPU 秒)
+    size = 0
+    started = time.process_time()
+    for _ in range(repeat):
+        encoder = GzipEncoder(wbits)
+        size = 0
+        for chunk in chunks:
+            size += len(encoder.compress(chunk))
+        size += len(encoder.finish())
+    return size, (time.process_time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--json", help="JSON array saved from /api/jobhist etc. (default: generated sample)")
+    parser.add_argument("--records", type=int, default=20, help="number of sample records (default: 20)")
+    parser.add_argument("--kbps", type=float, default=1000, help="effective link speed in kbit/s (default: 1000)")
+    parser.add_argument("--cpu-scale", type=float, default=1.0, help="Pico CPU time / host CPU time (default: 1)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per window size (default: 5)")
+    args = parser.parse_args()
+
+    if args.json:
+        with open(args.json, encoding="utf-8") as f:
+            records = json.load(f)
+    else:
+        records = sample_records(args.records)
+    chunks = list(iter_chunks(records))
+    raw = sum(len(c) for c in chunks)
+    bytes_per_sec = args.kbps * 1000 / 8
+
+    print("body: {} bytes in {} chunks, link {:.0f} kbit/s, cpu scale {:.1f}x".format(
+        raw, len(chunks), args.kbps, args.cpu_scale))
+    print("cpu ms: host zlib time x cpu scale (not measured on the device encoder)")
+    print("{:>6} {:>9} {:>6} {:>9} {:>9} {:>9}".format("wbits", "bytes", "ratio", "cpu ms", "air ms", "total ms"))
+    air_ms = raw / bytes_per_sec * 1000
+    print("{:>6} {:>9} {:>6.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format("none", raw, 1.0, 0.0, air_ms, air_ms))
+    for wbits in range(COMPRESS_MIN_WBITS, MAX_WBITS + 1):
+        size, cpu = measure(chunks, wbits, args.repeat)
+        cpu_ms = cpu * 1000 * args.cpu_scale
+        air_ms = size / bytes_per_sec * 1000
+        print("{:>6} {:>9} {:>6.2f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            wbits, size, raw / size, cpu_ms, air_ms, cpu_ms + air_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+www/ 以下の静的ファイルを事前圧縮し、隣に .gz を作るホスト側スクリプト
+
+Pico 上では圧縮せず、web.py の _serve_file が Accept-Encoding: gzip の
+クライアントに .gz をそのまま返す。www/ を編集したらデプロイ前に再実行すること。
+
+    python3 tools/gzip_www.py          # .gz を作成・更新
+    python3 tools/gzip_www.py --clean  # .gz を削除
+"""
+import argparse
+import gzip
+import os
+
+WWW_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "www")
+
+# テキスト系のみ圧縮する (JPEG などは圧縮しても小さくならない)
+COMPRESSIBLE = (".html", ".js", ".css")
+
+# これより小さいファイルは圧縮しても転送量がほぼ変わらない
+MIN_SIZE = 256
+
+
+def iter_targets(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if name.endswith(COMPRESSIBLE):
+                yield os.path.join(dirpath, name)
+
+
+def compress(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    gz_path = path + ".gz"
+    if len(data) < MIN_SIZE:
+        remove(gz_path)
+        return None
+    # mtime=0 で出力を再現可能にし、ETag が無駄に変わらないようにする
+    packed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(packed) >= len(data):
+        remove(gz_path)
+        return None
+    with open(gz_path, "wb") as f:
+        f.write(packed)
+    return len(data), len(packed)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clean", action="store_true", help="remove generated .gz files")
+    parser.add_argument("--root", default=WWW_DIR, help="static file directory (default: www/)")
+    args = parser.parse_args()
+
+    total_in = total_out = 0
+    for path in iter_targets(args.root):
+        rel = os.path.relpath(path, args.root)
+        if args.clean:
+            remove(path + ".gz")
+            continue
+        result = compress(path)
+        if result is None:
+            print("skip  {}".format(rel))
+            continue
+        size, packed = result
+        total_in += size
+        total_out += packed
+        print("gzip  {}: {} -> {} bytes ({:.1f}x)".format(rel, size, packed, size / packed))
+
+    if total_out:
+        print("total: {} -> {} bytes ({:.1f}x)".format(total_in, total_out, total_in / total_out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+www/ 以下の静的ファイルを 1 つの www.pack にまとめるホスト側スクリプト
+
+Pico 上では assets.py の AssetPack が起動時にインデックスだけを読み込み、
+リクエストごとに seek して返す。HTML/JS/CSS は gzip 版も同じパックに入れる。
+www/ を編集したらデプロイ前に再実行すること。
+
+    python3 tools/pack_www.py
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import struct
+
+from gzip_www import COMPRESSIBLE, MIN_SIZE
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WWW_DIR = os.path.join(ROOT_DIR, "www")
+PACK_PATH = os.path.join(ROOT_DIR, "www.pack")
+
+# assets.py と揃えること
+PACK_MAGIC = b"WPK1"
+HEADER_FORMAT = "<4sI"
+
+CONTENT_TYPES = (
+    (".html", "text/html"),
+    (".css", "text/css"),
+    (".js", "application/javascript"),
+    (".jpg", "image/jpeg"),
+    (".jpeg", "image/jpeg"),
+)
+
+# 実行時に書き換わるファイルはパックに入れない
+EXCLUDE = ("image.jpg",)
+
+
+def content_type(name):
+    lower = name.lower()
+    for ext, ctype in CONTENT_TYPES:
+        if lower.endswith(ext):
+            return ctype
+    return "text/plain"
+
+
+def iter_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(".gz") or name in EXCLUDE:
+                continue
+            path = os.path.join(dirpath, name)
+            yield "/" + os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def build(root):
+    index = {}
+    blob = bytearray()
+    for url, path in iter_files(root):
+        with open(path, "rb") as f:
+            data = f.read()
+        etag = hashlib.sha1(data).hexdigest()[:16]
+        entry = [content_type(url), etag, len(blob), len(data), 0, 0]
+        blob += data
+        if url.endswith(COMPRESSIBLE) and len(data) >= MIN_SIZE:
+            packed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(packed) < len(data):
+                entry[4] = len(blob)
+                entry[5] = len(packed)
+                blob += packed
+        index[url] = entry
+    return index, bytes(blob)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--root", default=WWW_DIR, help="static file directory (default: www/)")
+    parser.add_argument("--output", default=PACK_PATH, help="pack file path (default: www.pack)")
+    args = parser.parse_args()
+
+    index, blob = build(args.root)
+    index_bytes = json.dumps(index, separators=(",", ":")).encode()
+    with open(args.output, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, PACK_MAGIC, len(index_bytes)))
+        f.write(index_bytes)
+        f.write(blob)
+
+    for url, entry in index.items():
+        gz = " (gzip {} bytes)".format(entry[5]) if entry[5] else ""
+        print("pack  {}: {} bytes{}".format(url, entry[3], gz))
+    print("{}: {} files, index {} bytes, total {} bytes".format(
+        os.path.relpath(args.output, ROOT_DIR), len(index), len(index_bytes),
+        struct.calcsize(HEADER_FORMAT) + len(index_bytes) + len(blob)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import uos
+import ubinascii
+import uhashlib
+import time
+
+UPLOAD_DIR = "/www"
+UPLOAD_PREFIX = "upload-"
+TARGET_PATH = "/www/image.jpg"
+# 現在の image.jpg の SHA-256 (同じ画像の再アップロードを省くために使う)
+DIGEST_PATH = "/data/image.sha256"
+# 1 回の PUT で受け付ける最大バイト数 (本文は 1 KB ずつファイルへ流すので RAM は増えない)
+MAX_CHUNK = 32 * 1024
+# 画像全体の上限 (フラッシュの空き容量に合わせる)
+MAX_UPLOAD_SIZE = 512 * 1024
+MAX_SESSIONS = 2
+# これだけ操作のないセッションは、新しいセッションを作るときに捨てる
+SESSION_TTL_MS = 10 * 60 * 1000
+
+
+class UploadSession:
+    """
+    1 つのアップロードの状態 (一時ファイル、予告された全体の長さ、受信済みの長さ、SHA-256)
+    受信した分は書き込みと同時にハッシュに加えるので、確定時にファイルを読み直さない
+    length が None なら長さは事前に分からない (chunked の単一リクエスト)
+    """
+
+    def __init__(self, length):
+        self.id = ubinascii.hexlify(uos.urandom(8)).decode()
+        self.path = "{}/{}{}.tmp".format(UPLOAD_DIR, UPLOAD_PREFIX, self.id)
+        self.length = length
+        self.offset = 0
+        self.hash = uhashlib.sha256()
+        self.touched = time.ticks_ms()
+        open(self.path, "wb").close()
+
+    async def append(self, body, buf, limit):
+        """
+        body (RequestBody など) を読み切るまで一時ファイルに追記する
+        途中で切れても、書けた分までは offset に反映されるので続きから送れる。
+        limit を超える分が届いた場合は、そこで読むのをやめて False を返す
+        """
+        self.touched = time.ticks_ms()
+        with open(self.path, "ab") as file_obj:
+            while True:
+                n = await body.readinto(buf)
+                if not n:
+                    break
+                if self.offset + n > limit:
+                    return False
+                chunk = buf[:n]
+                file_obj.write(chunk)
+                self.hash.update(chunk)
+                self.offset += n
+        self.touched = time.ticks_ms()
+        return True
+
+    def hexdigest(self):
+        # uhashlib は digest() の後に update できないので、確定時に 1 回だけ呼ぶ
+        return ubinascii.hexlify(self.hash.digest()).decode()
+
+    def status(self):
+        return {"id": self.id, "offset": self.offset, "length": self.length, "max_chunk": MAX_CHUNK}
+
+    def remove(self):
+        try:
+            uos.remove(self.path)
+        except OSError:
+            pass
+
+
+class UploadSessions:
+    """
+    アップロードのセッションを ID ごとに保持する
+    接続やリクエストをまたぐ状態はすべてここに置き、WebServer には持たせない
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.digest = self.load_digest()
+        self.remove_orphans()
+
+    def load_digest(self):
+        try:
+            with open(DIGEST_PATH, "r") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def create(self, length):
+        # 上限に達していれば None (古いセッションを先に片付ける)
+        self.expire()
+        if len(self.sessions) >= self.max_sessions:
+            return None
+        session = UploadSession(length)
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, upload_id):
+        return self.sessions.get(upload_id)
+
+    def commit(self, session, expected_digest=None):
+        """
+        受信した画像を image.jpg にする
+        expected_digest (16 進数の SHA-256) と一致しなければ捨てて ValueError
+        """
+        # 同じファイルシステム内の rename で置き換えるので、途中の画像が見えることはない
+        del self.sessions[session.id]
+        digest = session.hexdigest()
+        if expected_digest and expected_digest.lower() != digest:
+            session.remove()
+            raise ValueError("checksum mismatch")
+        try:
+            uos.rename(session.path, TARGET_PATH)
+        except OSError:
+            # 上書きできないファイルシステムでは消してから置き換える
+            try:
+                uos.remove(TARGET_PATH)
+            except OSError:
+                pass
+            try:
+                uos.rename(session.path, TARGET_PATH)
+            except OSError:
+                session.remove()
+                raise
+        self.save_digest(digest)
+
+    def save_digest(self, digest):
+        self.digest = digest
+        try:
+            with open(DIGEST_PATH, "w") as f:
+                f.write(digest)
+        except OSError:
+            pass
+
+    def discard(self, session):
+        self.sessions.pop(session.id, None)
+        session.remove()
+
+    def expire(self):
+        now = time.ticks_ms()
+        for session in list(self.sessions.values()):
+            if time.ticks_diff(now, session.touched) > SESSION_TTL_MS:
+                self.discard(session)
+
+    def remove_orphans(self):
+        # 再起動前のセッションの一時ファイルは続きを送れないので消す
+        try:
+            names = uos.listdir(UPLOAD_DIR)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(UPLOAD_PREFIX) and name.endswith(".tmp"):
+                try:
+                    uos.remove(UPLOAD_DIR + "/" + name)
+                except OSError:
+                    pass
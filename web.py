@@ -2,9 +2,160 @@ import uasyncio as asyncio
 import ujson
 import os
 import gc
+import time
 import logger
+from assets import AssetPack
+import compress
+from compress import GzipEncoder, choose_wbits, COMPRESS_MIN_SIZE, COMPRESS_MAX_WBITS
+from jsonstream import JsonStreamSplitter, iter_json_array, iter_ndjson
+from metrics import Metrics
+from ratelimit import RateLimiter, COST_READ, COST_WRITE
+from snapshot import Snapshot
+from upload import UploadSessions, MAX_UPLOAD_SIZE, MAX_CHUNK
 
 BUFFER_SIZE = 1024
+# 起動時に確保する I/O バッファの数 (同時接続 1-2 人 + キャプティブポータルの検出通信)
+BUFFER_POOL_SIZE = 4
+# ヒープ残量がこれを下回ったときだけリクエスト前に GC する
+GC_LOW_WATER = 24 * 1024
+# 同時に処理するリクエスト数の上限と、新しい接続を受け付けるのに必要なヒープ残量
+# keep-alive で次のリクエストを待っている接続は数えない (ブラウザは 1 台で最大 6 本の接続を開く)
+MAX_ACTIVE_REQUESTS = 4
+MIN_FREE_HEAP = 16 * 1024
+# 受け付けられないときの応答 (解析もメモリ確保もせずに返せるよう事前にエンコードしておく)
+BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Retry-After: 2\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+# 送信元ごとのレート制限を超えたときの応答 (BUSY_RESPONSE と同じく事前にエンコードしておく)
+RATE_LIMITED_RESPONSE = (
+    b"HTTP/1.1 429 Too Many Requests\r\n"
+    b"Retry-After: 1\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+# 本文を送ってくるメソッド (保存・アップロード)。トークンを多めに使い、公開ページの取得より後に回す
+WRITE_METHODS = ("POST", "PUT", "DELETE")
+# 書き込みは、処理中の公開ページの取得がなくなるまで最大この時間だけ待ってから始める
+PRIORITY_WAIT_MS = 2000
+PRIORITY_POLL_MS = 20
+# keep-alive: 1 接続で処理する最大リクエスト数と、次のリクエストを待つ秒数
+KEEPALIVE_MAX_REQUESTS = 16
+KEEPALIVE_TIMEOUT = 5
+# 最初のリクエスト行を待つ秒数と、リクエスト行からヘッダー終端までの制限時間
+HEADER_TIMEOUT = 10
+# 本文の読み込みで、次のデータが届くまで待つ秒数
+BODY_TIMEOUT = 10
+# 本文全体の制限時間は BODY_TIMEOUT 秒に、受信済みの量をこの速度 (バイト/秒) で割った秒数を足したもの。
+# 少しずつ送り続けて 1 回ごとの期限だけをすり抜けるクライアント (slowloris) に接続を握らせない
+BODY_MIN_RATE = 1024
+# ヘッダーの上限 (1 行の長さ、行数、合計バイト数)
+MAX_HEADER_LINE = 1024
+MAX_HEADER_COUNT = 32
+MAX_HEADER_BYTES = 4096
+# /api/* の JSON 本文をキャッシュする合計バイト数の上限 (起動時のヒープ残量の 1/8 も超えない)
+API_CACHE_BUDGET = 8 * 1024
+
+# 更新されない同梱ライブラリ (www/lib/) は長期キャッシュ、それ以外は ETag で再検証させる
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+# Accept にこれを含む GET には、一覧を NDJSON (1 行に 1 件) で返す
+NDJSON_TYPE = "application/x-ndjson"
+
+# AP 側の自分のアドレス (キャプティブポータルのリダイレクト先)
+AP_IP = "192.168.4.1"
+# 端末が AP に参加した直後に送る接続確認のパス
+# Android: /generate_204, /gen_204 / Windows: /ncsi.txt / iOS・macOS: /hotspot-detect.html
+CAPTIVE_PATHS = {"/generate_204", "/gen_204", "/ncsi.txt", "/hotspot-detect.html"}
+
+# 拡張子と Content-Type の対応 (パックにないファイル用。辞書ではなくタプルでメモリを節約)
+CONTENT_TYPES = (
+    (".html", "text/html"),
+    (".css", "text/css"),
+    (".js", "application/javascript"),
+    (".jpg", "image/jpeg"),
+    (".jpeg", "image/jpeg"),
+)
+
+# 取り出すリクエストヘッダー (小文字)。それ以外のヘッダーは str にせず読み捨てる
+CAPTURED_HEADERS = (
+    "host", "connection", "content-length", "transfer-encoding", "expect",
+    "if-none-match", "if-modified-since", "if-range", "range",
+    "accept", "accept-encoding", "upload-offset", "upload-length", "x-content-sha256",
+)
+# 名前の長さ -> ((bytes, str), ...)。長さが同じものだけをバイト列のまま比べる
+_HEADERS_BY_LEN = {}
+for _name in CAPTURED_HEADERS:
+    _HEADERS_BY_LEN[len(_name)] = _HEADERS_BY_LEN.get(len(_name), ()) + ((_name.encode(), _name),)
+
+
+def _redirect_response(location, connection):
+    return ("HTTP/1.1 302 Found\r\n"
+            "Location: {}\r\n"
+            "Content-Length: 0\r\n"
+            "Connection: {}\r\n\r\n").format(location, connection).encode()
+
+
+# 接続確認への 302。まとめて届くので、毎回組み立てずにそのまま書けるよう事前にエンコードしておく
+# writer.keep_alive (False / True) で引く
+CAPTIVE_RESPONSES = (_redirect_response("http://" + AP_IP + "/", "close"),
+                     _redirect_response("http://" + AP_IP + "/", "keep-alive"))
+
+_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+           "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def http_date(secs):
+    t = time.gmtime(secs)
+    return "{}, {:02d} {} {} {:02d}:{:02d}:{:02d} GMT".format(
+        _DAYS[t[6]], t[2], _MONTHS[t[1] - 1], t[0], t[3], t[4], t[5])
+
+
+def parse_range(value, size):
+    """
+    Range ヘッダーの単一範囲 (bytes=a-b, bytes=a-, bytes=-n) を (先頭, 末尾) にする
+    複数範囲や解釈できない値は None (全体を返す)。満たせない範囲は ValueError
+    """
+    if not value.startswith("bytes=") or "," in value:
+        return None
+    parts = value[6:].split("-", 1)
+    if len(parts) != 2:
+        return None
+    first = parts[0].strip()
+    last = parts[1].strip()
+    if not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # 末尾から n バイト
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    end = int(last) if last else size - 1
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def collect_if_low():
+    # 毎回の gc.collect() は遅いので、残量が少ないときに限る (通常は gc.threshold に任せる)
+    if gc.mem_free() < GC_LOW_WATER:
+        gc.collect()
+
+
+def guess_type(filepath):
+    lower = filepath.lower()
+    for ext, content_type in CONTENT_TYPES:
+        if lower.endswith(ext):
+            return content_type
+    return "text/plain"
 
 
 class RefuseHttpsServer:
@@ -24,118 +175,605 @@ class RefuseHttpsServer:
             pass
 
 
+class HttpError(Exception):
+    """
+    リクエストを処理できないことが分かった時点で送出し、handle_client でエラーレスポンスにする
+    counter: metrics に数えるカウンター名
+    """
+
+    def __init__(self, status, message, counter):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.counter = counter
+
+
+class BufferPool:
+    """
+    起動時に確保した bytearray を接続ごとに貸し出す
+    チャンクごとに bytes を確保せず、readinto と memoryview のスライスで使い回す
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.free = [memoryview(bytearray(size)) for _ in range(count)]
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        # 使い切った場合は一時的に確保する
+        return memoryview(bytearray(self.size))
+
+    def release(self, buf):
+        if len(self.free) < self.count:
+            self.free.append(buf)
+
+
+class ResponseCache:
+    """
+    /api/* の GET で返す JSON 本文を bytes のまま保持する LRU キャッシュ
+    合計を budget バイト以内に収め、1 件が budget の半分を超えるものは保持しない。
+    データは保存でしか変わらないので、Storage の保存で該当セクションだけを捨てる。
+    """
+
+    def __init__(self, budget, low_water=GC_LOW_WATER):
+        self.budget = budget
+        self.max_entry = budget // 2
+        self.low_water = low_water
+        self.entries = {}
+        # 古い順のキー (エンドポイントは数個なのでリストで足りる)
+        self.order = []
+        self.size = 0
+
+    def get(self, key):
+        body = self.entries.get(key)
+        if body is not None and self.order[-1] != key:
+            self.order.remove(key)
+            self.order.append(key)
+        return body
+
+    def put(self, key, body):
+        self.invalidate(key)
+        if len(body) > self.max_entry:
+            return
+        while self.size + len(body) > self.budget:
+            self.invalidate(self.order[0])
+        self.entries[key] = body
+        self.order.append(key)
+        self.size += len(body)
+
+    def invalidate(self, key):
+        body = self.entries.pop(key, None)
+        if body is not None:
+            self.order.remove(key)
+            self.size -= len(body)
+
+    def evict_if_low(self):
+        # GC してもヒープが足りなければ、キャッシュを丸ごと手放す
+        if not self.entries or gc.mem_free() >= self.low_water:
+            return False
+        self.entries = {}
+        self.order = []
+        self.size = 0
+        return True
+
+
+def _find_byte(data, value, start, end):
+    for i in range(start, end):
+        if data[i] == value:
+            return i
+    return -1
+
+
+def _name_matches(line, name):
+    # ASCII の英字は 0x20 を立てると小文字になる ('-' と数字は変わらない)
+    for i in range(len(name)):
+        if line[i] | 0x20 != name[i]:
+            return False
+    return True
+
+
+def is_ip_address(host):
+    for c in host:
+        if c != "." and not ("0" <= c <= "9"):
+            return False
+    return True
+
+
+class Request:
+    """
+    1 件のリクエストの解析結果と、接続から読んだバイト列の受け口
+    接続ごとにプールから借り、keep-alive の各リクエストの前に reset で使い回す。
+    ヘッダー行は使い回す bytearray に読み、名前をバイト列のまま比べて CAPTURED_HEADERS だけを str にする。
+    ヘッダーの後ろまで読んだ分 (本文やパイプライン化された次のリクエスト) は buf に残し、readinto で先に返す。
+    """
+
+    __slots__ = ("stream", "client", "buf", "view", "start", "end", "method", "path", "query", "version",
+                 "headers", "content_length", "chunked", "expect_continue", "header_bytes")
+
+    def __init__(self, size=MAX_HEADER_LINE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.headers = {}
+        self.bind(None)
+
+    def bind(self, stream, client=None):
+        # client: 送信元の IP アドレス (レート制限の単位)
+        self.stream = stream
+        self.client = client
+        self.start = 0
+        self.end = 0
+        self.reset()
+
+    def reset(self):
+        self.method = None
+        self.path = None
+        self.query = ""
+        self.version = None
+        self.headers.clear()
+        self.content_length = 0
+        self.chunked = False
+        self.expect_continue = False
+        self.header_bytes = 0
+
+    async def _fill(self, deadline):
+        # 消費済みの先頭を詰めてから空きに読み足す。buf が満杯なら -1
+        # deadline (ticks_ms) を過ぎれば asyncio.TimeoutError。1 回ごとに残り時間だけ待つ
+        remaining_ms = time.ticks_diff(deadline, time.ticks_ms())
+        if remaining_ms <= 0:
+            raise asyncio.TimeoutError()
+        if self.start:
+            n = self.end - self.start
+            self.view[:n] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if self.end == len(self.buf):
+            return -1
+        n = await asyncio.wait_for(self.stream.readinto(self.view[self.end:]), remaining_ms / 1000)
+        if n:
+            self.end += n
+        return n
+
+    async def readline(self, deadline):
+        """
+        1 行 (改行を含む) を buf を指す memoryview で返す。次に読むまでの間だけ有効
+        切断されたら空、MAX_HEADER_LINE を超える行は None
+        deadline (ticks_ms) までに行が揃わなければ asyncio.TimeoutError
+        """
+        i = self.start
+        while True:
+            i = _find_byte(self.buf, 0x0A, i, self.end)
+            if i >= 0:
+                line = self.view[self.start:i + 1]
+                self.start = i + 1
+                return line
+            n = await self._fill(deadline)
+            if n == -1:
+                return None
+            if not n:
+                return self.view[self.start:self.start]
+            # 詰めた後の位置で、読み足した分だけを探す
+            i = self.end - n
+
+    async def readinto(self, buf, timeout):
+        n = self.end - self.start
+        if n:
+            n = min(n, len(buf))
+            buf[:n] = self.view[self.start:self.start + n]
+            self.start += n
+            return n
+        return await asyncio.wait_for(self.stream.readinto(buf), timeout)
+
+    async def read(self, idle_timeout):
+        """
+        リクエスト行とヘッダーを読む
+        idle_timeout 秒以内にリクエスト行の最初のバイトが来なければ (または切断されれば) False を返す。
+        その後は最初のバイトから HEADER_TIMEOUT 秒以内にリクエスト行とヘッダーを読み終えなければ 408、
+        上限を超えれば 431 の HttpError を送出する。リクエスト行が不正なら method を None のまま True を返す。
+        """
+        self.reset()
+        if self.start == self.end:
+            try:
+                n = await self._fill(time.ticks_add(time.ticks_ms(), idle_timeout * 1000))
+            except asyncio.TimeoutError:
+                return False
+            if not n:
+                return False
+        # 1 バイトずつ送り続けて 1 回ごとの待ち時間だけをすり抜けるクライアントに接続を握らせない
+        deadline = time.ticks_add(time.ticks_ms(), HEADER_TIMEOUT * 1000)
+        try:
+            line = await self.readline(deadline)
+        except asyncio.TimeoutError:
+            raise HttpError("408 Request Timeout", "Header Timeout", "timeouts")
+        if line is not None and not line:
+            return False
+        count = 0
+        while True:
+            if line is None:
+                raise HttpError("431 Request Header Fields Too Large", "Header Too Large", "headers_too_large")
+            count += 1
+            self.header_bytes += len(line)
+            if count > MAX_HEADER_COUNT or self.header_bytes > MAX_HEADER_BYTES:
+                raise HttpError("431 Request Header Fields Too Large", "Header Too Large", "headers_too_large")
+            if count == 1:
+                self._parse_request_line(line)
+            elif len(line) <= 2:
+                # 空行 (ヘッダーの終わり) または切断
+                break
+            else:
+                self._parse_header(line)
+
+            try:
+                line = await self.readline(deadline)
+            except asyncio.TimeoutError:
+                raise HttpError("408 Request Timeout", "Header Timeout", "timeouts")
+        return True
+
+    def _parse_request_line(self, line):
+        end = len(line)
+        while end and line[end - 1] in (0x0A, 0x0D):
+            end -= 1
+        sp1 = _find_byte(line, 0x20, 0, end)
+        sp2 = _find_byte(line, 0x20, sp1 + 1, end) if sp1 > 0 else -1
+        if sp2 < 0 or _find_byte(line, 0x20, sp2 + 1, end) >= 0:
+            return
+        try:
+            method = bytes(line[:sp1]).decode()
+            target = bytes(line[sp1 + 1:sp2]).decode()
+            self.version = bytes(line[sp2 + 1:end]).decode()
+        except UnicodeError:
+            return
+        # キャッシュ回避用のクエリ (?t=...) などはルーティングに使わない
+        q = target.find("?")
+        if q >= 0:
+            self.query = target[q + 1:]
+            target = target[:q]
+        self.path = target
+        self.method = method
+
+    def _parse_header(self, line):
+        colon = _find_byte(line, 0x3A, 0, len(line))
+        for name, key in _HEADERS_BY_LEN.get(colon, ()):
+            if _name_matches(line, name):
+                break
+        else:
+            return
+        try:
+            value = bytes(line[colon + 1:]).strip().decode()
+        except UnicodeError:
+            return
+        if key == "content-length":
+            try:
+                self.content_length = int(value)
+            except ValueError:
+                # 本文の長さが分からないと次のリクエストと区切れない
+                self.method = None
+        elif key == "transfer-encoding":
+            self.chunked = value.lower().endswith("chunked")
+        elif key == "expect":
+            self.expect_continue = value.lower() == "100-continue"
+        elif key == "host":
+            # ポート番号はキャプティブポータルの判定に使わない
+            port = value.find(":")
+            self.headers[key] = value[:port] if port >= 0 else value
+        else:
+            self.headers[key] = value
+
+
+def _body_timeout(started, received):
+    # 次の読み込みを待てる秒数。本文全体の期限を過ぎていれば asyncio.TimeoutError
+    deadline_ms = BODY_TIMEOUT * 1000 + received * 1000 // BODY_MIN_RATE
+    remaining_ms = deadline_ms - time.ticks_diff(time.ticks_ms(), started)
+    if remaining_ms <= 0:
+        raise asyncio.TimeoutError()
+    return min(BODY_TIMEOUT, remaining_ms / 1000)
+
+
+class RequestBody:
+    """
+    Content-Length で長さの決まったリクエスト本文の読み出し口
+    remaining が残ったままなら、次のリクエストと区切れないので接続を閉じる
+    """
+
+    def __init__(self, reader, content_length):
+        self.reader = reader
+        self.length = content_length
+        self.remaining = content_length
+        self.received = 0
+        self.started = time.ticks_ms()
+
+    async def readinto(self, buf):
+        if self.remaining <= 0:
+            return 0
+        # 途中で止まったクライアントにバッファを握られ続けないよう、1 回の読み込みと本文全体に期限を設ける
+        timeout = _body_timeout(self.started, self.received)
+        n = await self.reader.readinto(buf[:min(len(buf), self.remaining)], timeout)
+        if n:
+            self.remaining -= n
+            self.received += n
+        return n
+
+
+_HEX_DIGITS = b"0123456789abcdefABCDEF"
+# チャンクの長さの桁数の上限 (これを超える本文は受け付けない)
+MAX_CHUNK_SIZE_DIGITS = 8
+
+
+def _parse_chunk_size(line):
+    # 16 進数の数字だけを受け付ける。int(..., 16) は "-5" や "0x10" も通すので先に確かめる
+    digits = line.split(b";", 1)[0].strip()
+    if not digits or len(digits) > MAX_CHUNK_SIZE_DIGITS:
+        raise ValueError("bad chunk size")
+    for c in digits:
+        if c not in _HEX_DIGITS:
+            raise ValueError("bad chunk size")
+    return int(digits.decode(), 16)
+
+
+class ChunkedRequestBody:
+    """
+    Transfer-Encoding: chunked のリクエスト本文の読み出し口 (RequestBody と同じ使い方)
+    length は None。終端のチャンクまで読み終えるまで remaining は 0 にならない
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.length = None
+        self.remaining = 1
+        self.received = 0
+        self.chunk_left = 0
+        self.started = time.ticks_ms()
+
+    async def readline(self):
+        timeout_ms = int(_body_timeout(self.started, self.received) * 1000)
+        line = await self.reader.readline(time.ticks_add(time.ticks_ms(), timeout_ms))
+        if not line:
+            raise ValueError("bad chunk framing")
+        return line
+
+    async def end_of_line(self):
+        line = await self.readline()
+        return len(line) == 2 and line[0] == 0x0D
+
+    async def readinto(self, buf):
+        if not self.remaining:
+            return 0
+        if not self.chunk_left:
+            # チャンクの長さ (16 進数、拡張は無視)。0 なら trailer を読み飛ばして終わる
+            size = _parse_chunk_size(bytes(await self.readline()))
+            if size == 0:
+                while not await self.end_of_line():
+                    pass
+                self.remaining = 0
+                return 0
+            self.chunk_left = size
+        timeout = _body_timeout(self.started, self.received)
+        n = await self.reader.readinto(buf[:min(len(buf), self.chunk_left)], timeout)
+        if not n:
+            raise ValueError("truncated chunk")
+        self.chunk_left -= n
+        self.received += n
+        if not self.chunk_left and not await self.end_of_line():
+            raise ValueError("bad chunk framing")
+        return n
+
+
+class ResponseWriter:
+    """
+    StreamWriter を包み、1 接続内で送信中のレスポンスの状態を保持する
+    keep_alive: このレスポンスを送った後に接続を再利用するか
+    header_sent: ステータス行とヘッダーを送信済みか
+    request: 処理中のリクエスト (Request。ヘッダーは条件付き GET などの判定に使う)
+    chunked_ok: クライアントが Transfer-Encoding: chunked を受け取れるか (HTTP/1.1)
+    chunked: 送信中の本文をチャンク形式で包んでいるか
+    head: HEAD リクエストへの応答か (ヘッダーを送った後の本文は書かずに捨てる)
+    gzip_wbits: 0 以外なら、本文を gzip に圧縮して送る (窓のビット数)
+    encoder: 送信中の本文を圧縮している GzipEncoder
+    buf: この接続に貸し出した I/O バッファ (memoryview)
+    route, status, bytes_in, bytes_out: メトリクス用の記録
+    """
+
+    def __init__(self, writer, buf):
+        self.writer = writer
+        self.keep_alive = False
+        self.header_sent = False
+        self.request = None
+        self.chunked_ok = False
+        self.chunked = False
+        self.head = False
+        self.gzip_wbits = 0
+        self.encoder = None
+        self.buf = buf
+        self.route = "other"
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def reset(self, keep_alive, request=None, chunked_ok=False):
+        self.keep_alive = keep_alive
+        self.header_sent = False
+        self.request = request
+        self.chunked_ok = chunked_ok
+        self.chunked = False
+        self.head = request is not None and request.method == "HEAD"
+        self.gzip_wbits = 0
+        self.encoder = None
+        self.route = "other"
+        self.status = None
+        self.bytes_out = 0
+
+    def write(self, data):
+        if self.head and self.header_sent:
+            return
+        if self.encoder:
+            # 圧縮しきれていない分は GzipEncoder に残り、次の write か finish で出てくる
+            data = self.encoder.compress(data)
+        if self.chunked:
+            n = len(data)
+            if not n:
+                # 長さ 0 のチャンクは本文の終わりを意味するので送らない
+                return
+            size_line = ("%x\r\n" % n).encode()
+            self.bytes_out += len(size_line) + n + 2
+            self.writer.write(size_line)
+            self.writer.write(data)
+            self.writer.write(b"\r\n")
+            return
+        self.bytes_out += len(data)
+        self.writer.write(data)
+
+    async def finish(self):
+        if self.encoder:
+            # 圧縮の残りと gzip の末尾を送る
+            tail = self.encoder.finish()
+            self.encoder = None
+            self.write(tail)
+            await self.writer.drain()
+        # チャンク形式の本文を終端する。これで接続を閉じずに次のリクエストを読める
+        # HEAD では本文を送っていないので終端も送らない
+        if self.chunked:
+            self.chunked = False
+            if self.head:
+                return
+            self.bytes_out += 5
+            self.writer.write(b"0\r\n\r\n")
+            await self.writer.drain()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def wait_closed(self):
+        await self.writer.wait_closed()
+
+
 class WebServer:
-    def __init__(self, storage, sta=None):
-        self.upload_headers = {}
+    def __init__(self, storage, sta=None, max_requests=MAX_ACTIVE_REQUESTS, min_free_heap=MIN_FREE_HEAP,
+                 cache_budget=API_CACHE_BUDGET, gzip_max_wbits=COMPRESS_MAX_WBITS, dns=None, loop_monitor=None):
         self.storage = storage
         self.sta = sta
-        self.routes = {
-            "/": self.handle_index,
-            "/hotspot-detect.html": self.handle_hotspot_detect,
-            "/admin/user": self.handle_user,
-            "/admin/simplehist": self.handle_simplehist,
-            "/admin/jobhist": self.handle_jobhist,
-            "/admin/portrait": self.handle_portrait,
-            "/admin/log": self.handle_admin_log,
-            "/api/user": self.handle_api_user,
-            "/api/simplehist": self.handle_api_simplehist,
-            "/api/jobhist": self.handle_api_jobhist,
-            "/api/portrait": self.handle_api_portrait,
-            "/api/upload": self.handle_image_upload,
-            "/api/network": self.handle_api_network,
-        }
+        # /admin/metrics に載せる DNSServer と LoopMonitor (なくてもよい)
+        self.dns = dns
+        self.loop_monitor = loop_monitor
+        self.max_requests = max_requests
+        self.min_free_heap = min_free_heap
+        # 処理中のリクエスト数 (ヘッダーを読み終えてからレスポンスを送り終えるまで)
+        self.active_requests = 0
+        # 処理中の公開ページの取得 (書き込みはこれが 0 になるのを待つ)
+        self.public_active = 0
+        self.limiter = RateLimiter()
+        # /api の gzip の窓の上限 (実際の窓はリクエストごとにヒープ残量から選ぶ)
+        self.gzip_max_wbits = gzip_max_wbits
+        self.assets = AssetPack()
+        self.uploads = UploadSessions()
+        self.cache = ResponseCache(min(cache_budget, gc.mem_free() // 8))
+        storage.add_listener(self.cache.invalidate)
+        # 保存のたびに公開ページのスナップショットを作り直す。起動時にも (start で) テンプレートの更新に合わせて作る
+        self.snapshot = Snapshot(storage, self.assets)
+        storage.add_listener(self.snapshot.on_storage_write)
+        self.buffers = BufferPool(BUFFER_POOL_SIZE, BUFFER_SIZE)
+        # 接続ごとに貸し出す Request (ヘッダー行のバッファごと使い回す)
+        self.requests = [Request() for _ in range(BUFFER_POOL_SIZE)]
+        # (パス, 受け付けるメソッド, ハンドラー)
+        routes = (
+            ("/", ("GET",), self.handle_index),
+            ("/hotspot-detect.html", ("GET",), self.handle_hotspot_detect),
+            ("/admin/user", ("GET", "POST"), self.handle_user),
+            ("/admin/simplehist", ("GET", "POST"), self.handle_simplehist),
+            ("/admin/jobhist", ("GET", "POST"), self.handle_jobhist),
+            ("/admin/portrait", ("GET", "POST"), self.handle_portrait),
+            ("/admin/log", ("GET",), self.handle_admin_log),
+            ("/api/user", ("GET",), self.handle_api_user),
+            ("/api/simplehist", ("GET",), self.handle_api_simplehist),
+            ("/api/jobhist", ("GET",), self.handle_api_jobhist),
+            ("/api/portrait", ("GET",), self.handle_api_portrait),
+            ("/api/upload", ("GET", "HEAD", "POST"), self.handle_image_upload),
+            ("/api/network", ("GET",), self.handle_api_network),
+            ("/api/resume", ("GET",), self.handle_api_resume),
+            ("/admin/metrics", ("GET",), self.handle_admin_metrics),
+            ("/admin/dns", ("GET", "POST"), self.handle_admin_dns),
+        )
+        # 起動時に (メソッド, パス) -> ハンドラーの辞書にしておき、リクエストごとは 1 回引くだけにする
+        self.routes = {}
+        for path, methods, handler in routes:
+            for method in methods:
+                self.routes[(method, path)] = handler
+            # GET できるパスは HEAD も受け付ける (本文は ResponseWriter が捨てる)
+            if "GET" in methods and "HEAD" not in methods:
+                self.routes[("HEAD", path)] = handler
+        self.route_paths = {path for path, _, _ in routes}
+        # static: 静的ファイル, captive: キャプティブポータルのリダイレクト, other: 不正なリクエスト
+        self.metrics = Metrics(tuple(path for path, _, _ in routes) + ("static", "captive", "other"),
+                               ("accepted", "rejected_busy", "rejected_memory",
+                                "timeouts", "headers_too_large",
+                                "cache_hits", "cache_misses", "cache_evictions",
+                                "rate_limited", "writes_deferred"))
 
     async def start(self):
+        self.snapshot.schedule()
         _ = await asyncio.start_server(self.handle_client, "0.0.0.0", 80)
         while True:
             await asyncio.sleep(1)
 
     async def handle_client(self, reader, writer):
+        reason = self.admission_check()
+        if reason:
+            self.metrics.count(reason)
+            return await self.reject(writer)
+
+        self.metrics.count("accepted")
+        writer = ResponseWriter(writer, self.buffers.acquire())
+        request = self.requests.pop() if self.requests else Request()
+        peer = writer.writer.get_extra_info("peername")
+        request.bind(reader, peer[0] if peer else None)
+        started = None
+        in_flight = False
+        free_before = alloc_before = 0
         try:
-            gc.collect()
-            first_line, content_length, expect_continue, custom_headers = await self.parse_headers_optimized(reader)
-            if not first_line:
-                return await self.send_error(writer, "400 Bad Request", "Null Request")
-
-            method, path = self.parse_request_line(first_line)
-            if not method:
-                return await self.send_error(writer, "400 Bad Request", "Bad Request Line")
-
-            # Expect: 100-continue を確認し、レスポンスを返す
-            if expect_continue:
-                await self.send_continue(writer)
-
-            # --- Captive Portal Logic ---
-            # Check Host header and Path to detect captive portal probes
-            host = custom_headers.get('host', '').split(':')[0]
-            my_ip = "192.168.4.1"
-
-            # Common captive portal detection paths
-            # Android: /generate_204, /gen_204
-            # Windows: /ncsi.txt
-            # iOS/macOS: /hotspot-detect.html (though we also have a route for this)
-            captive_paths = ["/generate_204", "/gen_204",
-                             "/ncsi.txt", "/hotspot-detect.html"]
-
-            should_redirect = False
-
-            # Check if host is a domain name (contains letters) -> Redirect
-            # If it's an IP (e.g. 192.168.10.5 or 192.168.4.1), allow it.
-            is_ip = True
-            if host:
-                parts = host.split('.')
-                for p in parts:
-                    if not p.isdigit():
-                        is_ip = False
-                        break
-
-            if host and not is_ip:
-                should_redirect = True
-            # Redirect specific connectivity check paths
-            elif path in captive_paths:
-                should_redirect = True
-
-            if should_redirect:
-                return await self.send_redirect(writer, f"http://{my_ip}/")
-            # ---------------------------
-
-            body = None
-
-            if method == "POST" and content_length > 0:
-                if path == "/api/upload":
-                    # Pass reader and length to handler for chunked processing
-                    self.upload_headers = custom_headers
-                    body = {"reader": reader, "content_length": content_length}
-                else:
-                    try:
-                        success = await self.write_temp_file(reader, content_length)
-                        if not success:
-                            return await self.send_error(writer, "500 Internal Server Error", "File Write Error")
-                        body = self.load_json_from_file()
-                        if body is None:
-                            return await self.send_error(writer, "400 Bad Request", "JSON Decode Error")
-                    except (UnicodeError, ValueError):
-                        return await self.send_error(writer, "400 Bad Request", "JSON Decode Error")
-
-            if method == "GET" and path in self.routes and path.startswith("/admin") and path != "/admin/log":
-                return await self.serve_admin_static(writer, path)
-            elif method == "GET" and path in ("/api/jobhist", "/api/portrait"):
-                return await self.serve_csv_as_json(writer, path)
-            elif path in self.routes:
-                handler = self.routes[path]
-                if path.startswith("/api/"):
-                    content_type = "application/json"
-                elif path == "/admin/log":
-                    content_type = "text/plain"
-                else:
-                    content_type = "text/html"
-                await self.send_response_header(writer, "200 OK", content_type)
-                await handler(method, body, writer)
-            else:
-                return await self.serve_static_file(writer, path)
-
-            del body
-
+            for count in range(KEEPALIVE_MAX_REQUESTS):
+                collect_if_low()
+                if self.cache.evict_if_low():
+                    self.metrics.count("cache_evictions")
+                # 2 件目以降はアイドル時間を短く区切る。何も来なければ黙って接続を閉じる
+                if not await request.read(HEADER_TIMEOUT if count == 0 else KEEPALIVE_TIMEOUT):
+                    break
+                # uasyncio には Semaphore がないため、待たせずに数えて上限を超えた分を断る
+                if self.active_requests >= self.max_requests:
+                    self.metrics.count("rejected_busy")
+                    # 前のリクエスト (HEAD や gzip) の状態が残っていると書いた分が捨てられるので、先に戻す
+                    writer.reset(False)
+                    writer.write(BUSY_RESPONSE)
+                    await writer.drain()
+                    break
+                self.active_requests += 1
+                in_flight = True
+
+                is_last = count == KEEPALIVE_MAX_REQUESTS - 1
+                started = time.ticks_us()
+                free_before = gc.mem_free()
+                alloc_before = gc.mem_alloc()
+                await self.handle_request(request, writer, is_last)
+                await writer.finish()
+                self.active_requests -= 1
+                in_flight = False
+                self.record_metrics(writer, started, free_before, alloc_before)
+                started = None
+                if not writer.keep_alive:
+                    break
+
+        except HttpError as error:
+            self.metrics.count(error.counter)
+            try:
+                await self.send_error(writer, error.status, error.message)
+            except Exception:
+                pass
+        except asyncio.TimeoutError:
+            # 本文の途中で止まったクライアント
+            self.metrics.count("timeouts")
+            try:
+                await self.send_error(writer, "408 Request Timeout", "Body Timeout")
+            except Exception:
+                pass
         except MemoryError as error:
             logger.error("handle_client memory error: {}".format(error))
             gc.collect()
@@ -163,8 +801,139 @@ class WebServer:
                 pass
         finally:
             if writer:
+                # 例外で中断したリクエストも、エラーレスポンスを送った後に記録する
+                if started is not None:
+                    self.record_metrics(writer, started, free_before, alloc_before)
+                self.buffers.release(writer.buf)
+                request.bind(None)
+                if len(self.requests) < BUFFER_POOL_SIZE:
+                    self.requests.append(request)
                 await self.safe_close(writer)
                 del writer
+            if in_flight:
+                self.active_requests -= 1
+
+    def admission_check(self):
+        # 同時に処理するリクエスト数は、ヘッダーを読み終えた後に handle_client で数える
+        if gc.mem_free() < self.min_free_heap:
+            gc.collect()
+            if gc.mem_free() < self.min_free_heap:
+                return "rejected_memory"
+        return None
+
+    async def reject(self, writer):
+        try:
+            writer.write(BUSY_RESPONSE)
+            await writer.drain()
+        except Exception:
+            pass
+        await self.safe_close(writer)
+
+    def record_metrics(self, writer, started, free_before, alloc_before):
+        status = writer.status
+        self.metrics.record(writer.route, int(status[:3]) if status else 0,
+                            writer.bytes_in, writer.bytes_out,
+                            time.ticks_diff(time.ticks_us(), started), free_before, alloc_before)
+
+    async def handle_request(self, request, writer, is_last):
+        writer.reset(False, request)
+        writer.bytes_in = request.header_bytes
+        method = request.method
+        path = request.path
+        if not method:
+            return await self.send_error(writer, "400 Bad Request", "Bad Request Line")
+
+        # 上限件数に達した接続は、このレスポンスで閉じることをクライアントに伝える
+        writer.reset(not is_last and self.wants_keep_alive(request), request, request.version == "HTTP/1.1")
+
+        # 1 台のクライアントの再試行の繰り返しなどで、他のクライアントが待たされないようにする
+        is_write = method in WRITE_METHODS
+        if not self.limiter.allow(request.client, COST_WRITE if is_write else COST_READ):
+            return await self.send_rate_limited(writer)
+
+        # --- Captive Portal Logic ---
+        # ドメイン名宛て (他のサイトへのアクセス) と接続確認のパスは、ルーティングの前に事前に作った 302 を返す
+        # IP アドレス宛て (192.168.4.1 や STA 側のアドレス) はそのまま処理する
+        host = request.headers.get("host", "")
+        if path in CAPTIVE_PATHS or (host and host != AP_IP and not is_ip_address(host)):
+            return await self.send_captive_redirect(request, writer)
+
+        # 公開ページ (/ と静的ファイル、/api の取得) を保存やアップロードより先に処理する
+        # 100 Continue の前に待つので、待っている間にクライアントは本文を送ってこない
+        is_public = not is_write and not path.startswith("/admin")
+        if is_write:
+            await self.wait_for_public()
+
+        # Expect: 100-continue を確認し、レスポンスを返す
+        if request.expect_continue:
+            await self.send_continue(writer)
+
+        # 本文は一時ファイルに落とさず、各ハンドラーが RequestBody から直接読む
+        body = None
+        if method in ("POST", "PUT"):
+            if request.chunked:
+                body = ChunkedRequestBody(request)
+            elif request.content_length > 0:
+                body = RequestBody(request, request.content_length)
+        elif request.content_length or request.chunked:
+            # GET などの本文は読まないので、次のリクエストと区切れなくなる前に閉じる
+            writer.keep_alive = False
+
+        if is_public:
+            self.public_active += 1
+        try:
+            handler = self.routes.get((method, path))
+            if handler:
+                # 各ハンドラーが本文の長さに合わせてヘッダーを送る
+                writer.route = path
+                await handler(method, body, writer)
+            elif path in self.route_paths:
+                writer.route = path
+                await self.send_error(writer, "405 Method Not Allowed", "Method not allowed")
+            elif path.startswith("/api/upload/"):
+                writer.route = "/api/upload"
+                await self.handle_upload_session(method, body, writer, path[12:])
+            elif method in ("GET", "HEAD"):
+                writer.route = "static"
+                await self.serve_static_file(writer, path)
+            else:
+                writer.route = "static"
+                await self.send_error(writer, "405 Method Not Allowed", "Method not allowed")
+        finally:
+            if is_public:
+                self.public_active -= 1
+
+        if body:
+            writer.bytes_in += body.received
+            if body.remaining:
+                # 読み残した本文があると次のリクエストを正しく読めない
+                writer.keep_alive = False
+        del body
+
+    async def send_rate_limited(self, writer):
+        # 解析済みのヘッダーしか使わず、本文も読まずに閉じる
+        self.metrics.count("rate_limited")
+        writer.keep_alive = False
+        writer.write(RATE_LIMITED_RESPONSE)
+        writer.header_sent = True
+        writer.status = "429"
+        await writer.drain()
+
+    async def wait_for_public(self):
+        # uasyncio にはタスクの優先度がないため、公開ページの取得が終わるまで書き込みの開始を遅らせる
+        if not self.public_active:
+            return
+        self.metrics.count("writes_deferred")
+        waited = 0
+        while self.public_active and waited < PRIORITY_WAIT_MS:
+            await asyncio.sleep_ms(PRIORITY_POLL_MS)
+            waited += PRIORITY_POLL_MS
+
+    def wants_keep_alive(self, request):
+        connection = request.headers.get("connection", "").lower()
+        if request.version == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
 
     async def safe_close(self, writer):
         try:
@@ -176,296 +945,528 @@ class WebServer:
         writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
         await writer.drain()
 
-    async def write_temp_file(self, reader, content_length, temp_path="temp.json"):
-        try:
-            with open(temp_path, "wb") as file_obj:
-                remaining = content_length
-                bufsize = BUFFER_SIZE
-                while remaining > 0:
-                    chunk = await reader.read(min(bufsize, remaining))
-                    if not chunk:
-                        break
-                    file_obj.write(chunk)
-                    remaining -= len(chunk)
-            return True
-        except OSError as error:
-            logger.error("[write] Error: {}".format(error))
-            return False
-
-    def load_json_from_file(self, temp_path="temp.json"):
-        try:
-            with open(temp_path, "r") as file_obj:
-                return ujson.load(file_obj)
-        except Exception as error:
-            logger.error("Error parsing JSON file: {}".format(error))
-            return None
-
-    async def parse_headers_optimized(self, reader):
-        first_line = None
-        content_length = 0
-        expect_continue = False
-        custom_headers = {}
-
+    async def read_json_body(self, body, buf, on_record, expect_array):
+        # 本文を buf に読みながら JSON をレコード単位に分けて on_record に渡す
+        # 不正な JSON は UnicodeError / ValueError
+        splitter = JsonStreamSplitter(on_record, expect_array=expect_array)
         while True:
-            line = await reader.readline()
-            if not line or line == b"\r\n":
+            n = await body.readinto(buf)
+            if not n:
                 break
-            try:
-                line_str = line.decode("utf-8").strip()
-                if first_line is None:
-                    first_line = line_str
-                elif line_str.lower().startswith("content-length:"):
-                    content_length = int(line_str.split(":", 1)[1].strip())
-                elif line_str.lower().startswith("expect: 100-continue"):
-                    expect_continue = True
-                elif line_str.lower().startswith(("x-filename:", "x-final:", "host:")):
-                    key, value = line_str.split(":", 1)
-                    custom_headers[key.strip().lower()] = value.strip()
-            except (UnicodeError, ValueError):
-                return None, 0, False, {}
-        return first_line, content_length, expect_continue, custom_headers
-
-    def parse_request_line(self, line):
-        try:
-            method, path, _ = line.split()
-            return method, path
-        except ValueError:
-            return None, None
+            splitter.feed(buf[:n])
+        splitter.close()
 
-    async def send_response_header(self, writer, status, content_type):
+    async def store_json_body(self, body, buf, section):
+        # 本文を読みながら JSON をレコード単位に分け、そのまま CSV の一時ファイルへ書く
+        record_writer = self.storage.open_writer(section)
+        try:
+            await self.read_json_body(body, buf, record_writer.write, section != "user")
+        except (UnicodeError, ValueError) as error:
+            logger.error("JSON body error: {}".format(error))
+            record_writer.abort()
+            return False
+        except Exception:
+            record_writer.abort()
+            raise
+        record_writer.commit()
+        return True
+
+    async def send_response_header(self, writer, status, content_type, content_length=None, extra=""):
+        # 長さの分からない本文は、HTTP/1.1 ならチャンク形式で送って接続を残し、
+        # HTTP/1.0 なら切断で終端するため keep-alive をやめる
+        chunked = False
+        if content_length is None:
+            if writer.chunked_ok:
+                length_line = "Transfer-Encoding: chunked\r\n"
+                chunked = True
+            else:
+                writer.keep_alive = False
+                length_line = ""
+        else:
+            length_line = f"Content-Length: {content_length}\r\n"
+        if writer.gzip_wbits and content_length != 0:
+            # 圧縮後の長さは送り終えるまで分からない
+            extra += "Content-Encoding: gzip\r\n"
+            if content_length is not None:
+                content_length = None
+                if writer.chunked_ok:
+                    length_line = "Transfer-Encoding: chunked\r\n"
+                    chunked = True
+                else:
+                    writer.keep_alive = False
+                    length_line = ""
+        connection = "keep-alive" if writer.keep_alive else "close"
         header = (
             f"HTTP/1.1 {status}\r\n"
             f"Content-Type: {content_type}\r\n"
-            f"Connection: close\r\n\r\n"
+            f"{length_line}"
+            f"{extra}"
+            f"Connection: {connection}\r\n\r\n"
         ).encode()
         writer.write(header)
+        writer.header_sent = True
+        writer.chunked = chunked
+        writer.status = status
+        if writer.gzip_wbits and content_length is None:
+            writer.encoder = GzipEncoder(writer.gzip_wbits)
         await writer.drain()
 
-    async def send_error(self, writer, status, message):
-        await self.send_response_header(writer, status, "application/json")
-        error_data = ujson.dumps({"status": "error", "message": message})
-        await self.send_chunked(writer, error_data.encode())
+    async def send_body(self, writer, status, content_type, data, extra=""):
+        await self.send_response_header(writer, status, content_type, len(data), extra)
+        await self.send_chunked(writer, data)
 
-    async def send_redirect(self, writer, location):
+    async def send_json(self, writer, obj, status="200 OK", extra=""):
+        await self.send_body(writer, status, "application/json", ujson.dumps(obj).encode(), extra)
+
+    def is_not_modified(self, writer, etag, last_modified=None):
+        headers = writer.request.headers
+        if_none_match = headers.get("if-none-match")
+        # If-None-Match がある場合は If-Modified-Since より優先する
+        if if_none_match is not None:
+            return if_none_match == "*" or etag in if_none_match
+        return last_modified is not None and headers.get("if-modified-since") == last_modified
+
+    async def send_not_modified(self, writer, extra):
+        connection = "keep-alive" if writer.keep_alive else "close"
         header = (
-            f"HTTP/1.1 302 Found\r\n"
-            f"Location: {location}\r\n"
-            f"Connection: close\r\n\r\n"
+            f"HTTP/1.1 304 Not Modified\r\n"
+            f"{extra}"
+            f"Connection: {connection}\r\n\r\n"
         ).encode()
         writer.write(header)
+        writer.header_sent = True
+        writer.status = "304"
+        await writer.drain()
+
+    async def send_error(self, writer, status, message):
+        if writer.header_sent:
+            # 本文の途中ではヘッダーを送り直せないので、終端のチャンクを送らずに切断してエラーを知らせる
+            writer.keep_alive = False
+            writer.chunked = False
+            writer.encoder = None
+            return
+        # エラー後は読み残しの本文があり得るため接続を閉じる
+        writer.keep_alive = False
+        await self.send_json(writer, {"status": "error", "message": message}, status)
+
+    async def send_captive_redirect(self, request, writer):
+        writer.route = "captive"
+        if request.content_length or request.chunked:
+            # 本文は読まないので、次のリクエストと区切れなくなる前に閉じる
+            writer.keep_alive = False
+        writer.write(CAPTIVE_RESPONSES[writer.keep_alive])
+        writer.header_sent = True
+        writer.status = "302"
         await writer.drain()
 
     async def send_chunked(self, writer, data):
         chunk_size = BUFFER_SIZE
         data_len = len(data)
+        # bytes のスライスはコピーになるので memoryview で切り出す
+        view = memoryview(data)
         for i in range(0, data_len, chunk_size):
             end_pos = min(i + chunk_size, data_len)
-            writer.write(data[i:end_pos])
+            writer.write(view[i:end_pos])
             await writer.drain()
 
     async def serve_static_file(self, writer, path):
         return await self._serve_file(writer, 'www' + path)
 
-    async def serve_admin_static(self, writer, path):
-        return await self._serve_file(writer, 'www' + path.replace("/admin", "") + ".html")
-
     async def _serve_file(self, writer, filepath):
-        try:
-            # パストラバーサル対策: ".." を含むパスを拒否
-            if ".." in filepath or not filepath.startswith("www"):
-                return await self.send_error(writer, "403 Forbidden", "Access Denied")
-
-            # ファイル拡張子を効率的に取得
-            dot_pos = filepath.rfind('.')
-            if dot_pos != -1:
-                file_extension = filepath[dot_pos:].lower()
-            else:
-                file_extension = ''
-
-            # 辞書をタプルのペアに変更してメモリ使用量を削減
-            if file_extension == ".css":
-                content_type = "text/css"
-            elif file_extension == ".js":
-                content_type = "application/javascript"
-            elif file_extension in (".jpg", ".jpeg"):
-                content_type = "image/jpeg"
-            elif file_extension == ".html":
-                content_type = "text/html"
-            else:
-                content_type = "text/plain"
-
-            await self.send_response_header(writer, "200 OK", content_type)
+        # パストラバーサル対策: ".." を含むパスを拒否
+        if ".." in filepath or not filepath.startswith("www"):
+            return await self.send_error(writer, "403 Forbidden", "Access Denied")
 
-            # Always serve files as binary to avoid encoding issues
-            with open(filepath, "rb") as file_obj:
-                while True:
-                    chunk = file_obj.read(BUFFER_SIZE)
-                    if not chunk:
-                        break
-                    writer.write(chunk)
-                    await writer.drain()
-        except OSError:
-            await self.send_error(writer, "404 Not Found", "Not Found")
-
-    async def serve_csv_as_json(self, writer, path):
-        filename = "data" + path.replace("/api", "") + ".csv"
-        field_map = {
-            "/api/jobhist": ("job_no", "job_name", "job_description"),
-            "/api/portrait": ("portrait_no", "portrait_url", "portrait_summary")
-        }
-        keys = field_map.get(path)
-        if not keys:
-            return await self.send_error(writer, "400 Bad Request", "Unknown API path")
-
-        await self.send_response_header(writer, "200 OK", "application/json")
-        writer.write(b'[\r\n')
-        await writer.drain()
+        # www.pack にあるファイルはパックから返し、個別のファイルを開かない
+        entry = self.assets.find(filepath[3:])
+        if entry:
+            return await self._send_packed(writer, filepath, entry)
 
         try:
-            with open(filename, "r") as file_obj:
-                first = True
-                while True:
-                    line = file_obj.readline()
-                    if not line:
-                        break
-                    line = line.strip()
-                    if line:
-                        if not first:
-                            writer.write(b',')
-                        values = line.split(",", len(keys) - 1)
-                        # <br> を \n に戻す
-                        values = [v.replace("<br>", "\n") for v in values]
-                        record = {k: (int(v) if k.endswith("_no") else v)
-                                  for k, v in zip(keys, values)}
-                        await self.send_chunked(writer, ujson.dumps(record).encode() + b'\r\n')
-                        first = False
-                        del values, record
+            variant = self._select_variant(writer, filepath)
         except OSError:
-            pass
-        writer.write(b']\r\n\r\n')
-        await writer.drain()
-
-    async def stream_file(self, writer, path):
+            return await self.send_error(writer, "404 Not Found", "Not Found")
+
+        await self._send_file(writer, filepath, guess_type(filepath), variant)
+
+    def _cache_control(self, filepath):
+        return CACHE_IMMUTABLE if filepath.startswith("www/lib/") else CACHE_REVALIDATE
+
+    async def _send_packed(self, writer, filepath, entry):
+        content_type, etag, offset, length, gz_offset, gz_length = entry
+        extra = ""
+        if gz_length and "gzip" in writer.request.headers.get("accept-encoding", ""):
+            offset, length = gz_offset, gz_length
+            etag += "-gz"
+            extra = "Content-Encoding: gzip\r\n"
+        etag = '"' + etag + '"'
+        extra = f"ETag: {etag}\r\nCache-Control: {self._cache_control(filepath)}\r\nVary: Accept-Encoding\r\n" + extra
+        if self.is_not_modified(writer, etag):
+            return await self.send_not_modified(writer, extra)
+
+        async def write_part(start, count):
+            if await self.assets.write_range(writer, offset + start, count, writer.buf) < count:
+                writer.keep_alive = False
+
+        await self._send_content(writer, content_type, length, etag, None, extra, write_part)
+
+    def _select_variant(self, writer, filepath):
+        # gzip を受け付けるクライアントには、tools/gzip_www.py で作った .gz をそのまま返す
+        if "gzip" in writer.request.headers.get("accept-encoding", ""):
+            try:
+                return filepath + ".gz", os.stat(filepath + ".gz")
+            except OSError:
+                pass
+        return filepath, os.stat(filepath)
+
+    async def _send_file(self, writer, filepath, content_type, variant):
+        # サイズと更新時刻から検証子を作り、変わっていなければ本文を送らない
+        path, stat = variant
+        size = stat[6]
+        etag = '"{:x}-{:x}"'.format(size, stat[8])
+        last_modified = http_date(stat[8])
+        cache_control = self._cache_control(filepath)
+        extra = (f"ETag: {etag}\r\nLast-Modified: {last_modified}\r\n"
+                 f"Cache-Control: {cache_control}\r\nVary: Accept-Encoding\r\n")
+        if path is not filepath:
+            extra += "Content-Encoding: gzip\r\n"
+        if self.is_not_modified(writer, etag, last_modified):
+            return await self.send_not_modified(writer, extra)
+
+        async def write_part(start, count):
+            await self._write_file(writer, path, count, start)
+
+        await self._send_content(writer, content_type, size, etag, last_modified, extra, write_part)
+
+    async def _send_content(self, writer, content_type, size, etag, last_modified, extra, write_part):
+        # Range があれば 206 で一部だけ返す。途中で切れたダウンロードを続きから取り直せる
+        extra += "Accept-Ranges: bytes\r\n"
+        headers = writer.request.headers
+        span = None
+        if_range = headers.get("if-range")
+        if "range" in headers and (if_range is None or if_range == etag or if_range == last_modified):
+            try:
+                span = parse_range(headers["range"], size)
+            except ValueError:
+                return await self.send_response_header(
+                    writer, "416 Range Not Satisfiable", "text/plain", 0, f"Content-Range: bytes */{size}\r\n")
+        if span is None:
+            await self.send_response_header(writer, "200 OK", content_type, size, extra)
+            if not writer.head:
+                await write_part(0, size)
+            return
+
+        start, end = span
+        extra += f"Content-Range: bytes {start}-{end}/{size}\r\n"
+        await self.send_response_header(writer, "206 Partial Content", content_type, end - start + 1, extra)
+        if not writer.head:
+            await write_part(start, end - start + 1)
+
+    async def _write_file(self, writer, filepath, length, offset=0):
+        # Content-Length を超えて書くと次のレスポンスと混ざるため length で打ち切る
+        # Always serve files as binary to avoid encoding issues
+        with open(filepath, "rb") as file_obj:
+            if offset:
+                file_obj.seek(offset)
+            await self._write_stream(writer, file_obj, length)
+
+    async def _write_stream(self, writer, file_obj, length):
+        # 開いたファイルの現在位置から length バイトを送る
+        buf = writer.buf
+        bufsize = len(buf)
+        remaining = length
+        while remaining > 0:
+            n = file_obj.readinto(buf[:min(bufsize, remaining)])
+            if not n:
+                break
+            writer.write(buf[:n])
+            remaining -= n
+            await writer.drain()
+        if remaining > 0:
+            # 途中でファイルが縮んだ場合は長さが合わないので切断で終える
+            writer.keep_alive = False
+
+    async def write_chunks(self, writer, chunks):
+        # エンコーダーが返す断片を順に送る。全体を 1 つの bytes にしない
+        for chunk in chunks:
+            await self.send_chunked(writer, chunk)
+            del chunk
+
+    async def handle_image_upload(self, method, data, writer):
+        # POST /api/upload: 本文があれば 1 回のリクエストで画像全体を受け取る。
+        # 本文がなければセッションを作り、以降は /api/upload/<id> に PUT で送る
+        if method in ("GET", "HEAD"):
+            return await self.send_upload_digest(writer, method)
+        if data is not None:
+            return await self.receive_image(data, writer)
         try:
-            with open(path, "r") as file_obj:
-                while True:
-                    line = file_obj.readline()
-                    if not line:
-                        break
-                    writer.write(line.encode("utf-8"))
-                    await writer.drain()
-        except OSError:
-            await self.send_error(writer, "500 Internal Server Error", "File read error")
-
-    async def handle_image_upload(self, method, data, writer=None):
-        if method != "POST":
-            error_msg = ujson.dumps(
-                {"status": "error", "message": "Method not allowed"})
-            return await self.send_chunked(writer, error_msg.encode())
-
-        filename = self.upload_headers.get("x-filename", "tmp.jpg")
-        is_final = self.upload_headers.get(
-            "x-final", "false").lower() == "true"
-
-        # data is {"reader": reader, "content_length": content_length}
-        reader = data.get("reader")
-        content_length = data.get("content_length", 0)
-
+            length = int(writer.request.headers.get("upload-length", ""))
+        except ValueError:
+            return await self.send_error(writer, "400 Bad Request", "Missing Upload-Length")
+        if length <= 0 or length > MAX_UPLOAD_SIZE:
+            return await self.send_error(writer, "413 Payload Too Large", "Upload too large")
+
+        session = await self.create_upload(length, writer)
+        if session is None:
+            return
+        extra = f"Location: /api/upload/{session.id}\r\n"
+        return await self.send_json(writer, session.status(), "201 Created", extra)
+
+    async def send_upload_digest(self, writer, method):
+        # 現在の画像の SHA-256 を ETag として返す。If-None-Match が一致すれば同じ画像なので送らなくてよい
+        digest = self.uploads.digest
+        etag = f'"{digest}"' if digest else None
+        extra = "Cache-Control: no-cache\r\n"
+        if etag:
+            extra = f"ETag: {etag}\r\n" + extra
+            if self.is_not_modified(writer, etag):
+                return await self.send_not_modified(writer, extra)
+        if method == "HEAD":
+            return await self.send_response_header(writer, "200 OK", "application/json", 0, extra)
+        return await self.send_json(writer, {"sha256": digest}, extra=extra)
+
+    async def create_upload(self, length, writer):
         try:
-            with open("/www/" + filename, "ab") as file_obj:
-                remaining = content_length
-                bufsize = BUFFER_SIZE
-                while remaining > 0:
-                    chunk = await reader.read(min(bufsize, remaining))
-                    if not chunk:
-                        break
-                    file_obj.write(chunk)
-                    remaining -= len(chunk)
-                    gc.collect()
+            session = self.uploads.create(length)
+        except OSError as error:
+            logger.error("Upload create error: {}".format(error))
+            await self.send_error(writer, "500 Internal Server Error", "Write Error: " + str(error))
+            return None
+        if session is None:
+            await self.send_error(writer, "503 Service Unavailable", "Too many uploads")
+        return session
+
+    async def receive_image(self, data, writer):
+        # 本文を固定長のバッファで一時ファイルへ流しながら SHA-256 を計算し、X-Content-SHA256 と照合してから確定する
+        if data.length is not None and data.length > MAX_UPLOAD_SIZE:
+            return await self.send_error(writer, "413 Payload Too Large", "Upload too large")
+        session = await self.create_upload(data.length, writer)
+        if session is None:
+            return
+        try:
+            complete = await session.append(data, writer.buf, MAX_UPLOAD_SIZE)
+        except asyncio.TimeoutError:
+            self.uploads.discard(session)
+            raise
+        except ValueError:
+            self.uploads.discard(session)
+            return await self.send_error(writer, "400 Bad Request", "Bad Chunked Body")
         except Exception as error:
+            self.uploads.discard(session)
             logger.error("Upload write error: {}".format(error))
-            error_msg = ujson.dumps(
-                {"status": "error", "message": "Write Error: " + str(error)})
-            return await self.send_chunked(writer, error_msg.encode())
-
-        if is_final:
-            try:
-                # Remove existing file if it exists to ensure clean rename
-                try:
-                    os.remove("/www/image.jpg")
-                except OSError:
-                    pass
+            return await self.send_error(writer, "500 Internal Server Error", "Write Error: " + str(error))
+        if not complete:
+            self.uploads.discard(session)
+            return await self.send_error(writer, "413 Payload Too Large", "Upload too large")
+        if data.remaining:
+            # 接続が途中で切れた (RequestBody は EOF で 0 を返す)
+            self.uploads.discard(session)
+            return await self.send_error(writer, "400 Bad Request", "Incomplete Body")
+        return await self.commit_upload(session, writer)
+
+    async def handle_upload_session(self, method, data, writer, upload_id):
+        session = self.uploads.get(upload_id)
+        if session is None:
+            return await self.send_error(writer, "404 Not Found", "Unknown upload")
+        if method in ("GET", "HEAD"):
+            # 中断したクライアントは受信済みの長さを聞いて続きから送る
+            return await self.send_json(writer, session.status(), extra="Cache-Control: no-store\r\n")
+        if method == "PUT":
+            return await self.put_upload_chunk(session, data, writer)
+        if method == "POST":
+            return await self.commit_upload(session, writer)
+        if method == "DELETE":
+            self.uploads.discard(session)
+            return await self.send_json(writer, {"status": "success", "message": "Upload discarded"})
+        return await self.send_error(writer, "405 Method Not Allowed", "Method not allowed")
 
-                os.rename("/www/" + filename, "/www/image.jpg")
-                success_msg = ujson.dumps(
-                    {"status": "success", "message": "Upload complete"})
-                return await self.send_chunked(writer, success_msg.encode())
-            except OSError as error:
-                logger.error("Upload rename error: {}".format(error))
-                error_msg = ujson.dumps(
-                    {"status": "error", "message": "Failure Rename: " + str(error)})
-                return await self.send_chunked(writer, error_msg.encode())
+    async def put_upload_chunk(self, session, data, writer):
+        try:
+            offset = int(writer.request.headers.get("upload-offset", ""))
+        except ValueError:
+            return await self.send_error(writer, "400 Bad Request", "Missing Upload-Offset")
+        if data is None:
+            return await self.send_error(writer, "400 Bad Request", "Empty Body")
+        if offset != session.offset:
+            # 本文は読まずに、サーバーが持っている長さを返す
+            writer.keep_alive = False
+            return await self.send_json(writer, session.status(), "409 Conflict")
+        if data.length is not None and (data.length > MAX_CHUNK or offset + data.length > session.length):
+            return await self.send_error(writer, "413 Payload Too Large", "Chunk too large")
 
-        success_msg = ujson.dumps(
-            {"status": "success", "message": "Chunk received"})
-        return await self.send_chunked(writer, success_msg.encode())
+        try:
+            # 途中で切れても、書けた分までは次の PUT で続きから送れる
+            complete = await session.append(data, writer.buf, min(session.length, offset + MAX_CHUNK))
+        except asyncio.TimeoutError:
+            raise
+        except ValueError:
+            return await self.send_error(writer, "400 Bad Request", "Bad Chunked Body")
+        except Exception as error:
+            # 書き込みに失敗したファイルは続きを書けないので捨てる
+            self.uploads.discard(session)
+            logger.error("Upload write error: {}".format(error))
+            return await self.send_error(writer, "500 Internal Server Error", "Write Error: " + str(error))
+        if not complete:
+            return await self.send_error(writer, "413 Payload Too Large", "Chunk too large")
+        return await self.send_json(writer, session.status())
+
+    async def commit_upload(self, session, writer):
+        if session.length is not None and session.offset != session.length:
+            return await self.send_json(writer, session.status(), "409 Conflict")
+        try:
+            self.uploads.commit(session, writer.request.headers.get("x-content-sha256"))
+        except ValueError:
+            return await self.send_error(writer, "400 Bad Request", "Checksum mismatch")
+        except OSError as error:
+            logger.error("Upload rename error: {}".format(error))
+            return await self.send_error(writer, "500 Internal Server Error", "Failure Rename: " + str(error))
+        return await self.send_json(writer, {"status": "success", "message": "Upload complete",
+                                             "sha256": self.uploads.digest})
 
     async def handle_index(self, method, data, writer):
-        if not self.storage.read_user():
-            return await self.send_chunked(writer, b"User data is empty. Please go to /admin/user")
-        return await self.stream_file(writer, "www/index.html")
+        # 保存時に作ったスナップショットがあれば、データ埋め込み済みの HTML をそのまま返す
+        # 作り直しで消されたり置き換えられたりしても本文が Content-Length と合うよう、先に開いて開いた方の長さを使う
+        try:
+            file_obj = open(self.snapshot.path, "rb")
+        except OSError:
+            file_obj = None
+        if file_obj:
+            try:
+                size = file_obj.seek(0, 2)
+                if size:
+                    file_obj.seek(0)
+                    return await self._send_snapshot(writer, file_obj, size)
+            finally:
+                file_obj.close()
+        if self.cached_json("user") == b"{}":
+            return await self.send_body(writer, "200 OK", "text/html", b"User data is empty. Please go to /admin/user")
+        return await self._serve_file(writer, "www/index.html")
+
+    async def _send_snapshot(self, writer, file_obj, size):
+        # 内容は保存でしか変わらないので、全セクションの世代番号を ETag にする
+        etag = self.storage.etag("user", "simplehist", "jobhist", "portrait")[:-1] + '-html"'
+        extra = f"ETag: {etag}\r\nCache-Control: {CACHE_REVALIDATE}\r\n"
+        if self.is_not_modified(writer, etag):
+            return await self.send_not_modified(writer, extra)
+        await self.send_response_header(writer, "200 OK", "text/html", size, extra)
+        if not writer.head:
+            await self._write_stream(writer, file_obj, size)
 
     async def handle_hotspot_detect(self, method, data, writer):
-        return await self.stream_file(writer, "www/hotspot-detect.html")
-
-    async def html_post_handler(self, method, data, filepath, write_func, writer):
-        if method == "GET":
-            return await self.stream_file(writer, filepath)
-        if method == "POST":
-            write_func(data)
-            success_msg = ujson.dumps({"status": "success"})
-            return await self.send_chunked(writer, success_msg.encode())
+        return await self._serve_file(writer, "www/hotspot-detect.html")
+
+    async def html_post_handler(self, method, data, filepath, section, writer):
+        # GET (HEAD) は管理画面の HTML、POST は保存 (それ以外のメソッドはルーティングで 405 にしている)
+        if method in ("GET", "HEAD"):
+            return await self._serve_file(writer, filepath)
+        if data is None:
+            return await self.send_error(writer, "400 Bad Request", "Empty Body")
+        if not await self.store_json_body(data, writer.buf, section):
+            return await self.send_error(writer, "400 Bad Request", "JSON Decode Error")
+        return await self.send_json(writer, {"status": "success"})
 
     async def handle_user(self, method, data, writer):
-        return await self.html_post_handler(method, data, "www/user.html", self.storage.write_user, writer)
+        return await self.html_post_handler(method, data, "www/user.html", "user", writer)
 
     async def handle_simplehist(self, method, data, writer):
-        return await self.html_post_handler(method, data, "www/simplehist.html", self.storage.write_simplehist, writer)
+        return await self.html_post_handler(method, data, "www/simplehist.html", "simplehist", writer)
 
     async def handle_jobhist(self, method, data, writer):
-        return await self.html_post_handler(method, data, "www/jobhist.html", self.storage.write_jobhist, writer)
+        return await self.html_post_handler(method, data, "www/jobhist.html", "jobhist", writer)
 
     async def handle_portrait(self, method, data, writer):
-        return await self.html_post_handler(method, data, "www/portrait.html", self.storage.write_portrait, writer)
-
-    async def api_get_handler(self, method, read_func, writer):
-        if method == "GET":
-            data = read_func()
-            json_data = ujson.dumps(data)
-            return await self.send_chunked(writer, json_data.encode())
-        error_msg = ujson.dumps(
-            {"status": "error", "message": "Method not allowed"})
-        return await self.send_chunked(writer, error_msg.encode())
+        return await self.html_post_handler(method, data, "www/portrait.html", "portrait", writer)
+
+    def negotiate_gzip(self, writer, etag, size=None):
+        """
+        /api の JSON を gzip で送るか決める。送るなら writer.gzip_wbits を設定し、ETag を -gz 付きにして返す
+        窓はその時点のヒープ残量で選ぶ。size (分かれば本文の長さ) が小さい場合と、ヒープが足りない場合は圧縮しない
+        """
+        if not compress.AVAILABLE or "gzip" not in writer.request.headers.get("accept-encoding", ""):
+            return etag
+        if size is not None and size < COMPRESS_MIN_SIZE:
+            return etag
+        wbits = choose_wbits(gc.mem_free(), self.gzip_max_wbits)
+        if not wbits:
+            return etag
+        writer.gzip_wbits = wbits
+        return etag[:-1] + '-gz"'
+
+    async def api_get_handler(self, method, section, writer):
+        if section == "user":
+            body = self.cached_json(section)
+            etag = self.negotiate_gzip(writer, self.storage.etag(section), len(body))
+            extra = f"ETag: {etag}\r\nCache-Control: {CACHE_REVALIDATE}\r\nVary: Accept-Encoding\r\n"
+            if self.is_not_modified(writer, etag):
+                return await self.send_not_modified(writer, extra)
+            return await self.send_body(writer, "200 OK", "application/json", body, extra)
+        return await self.serve_records(writer, section)
+
+    async def serve_records(self, writer, section):
+        # 一覧のセクションはすべてここを通り、Storage のイテレーターを JSON 配列か NDJSON で流す
+        etag = self.storage.etag(section)
+        content_type = "application/json"
+        if NDJSON_TYPE in writer.request.headers.get("accept", ""):
+            content_type = NDJSON_TYPE
+            etag = etag[:-1] + '-nd"'
+        # CSV の大きさを JSON の大きさの目安にする
+        etag = self.negotiate_gzip(writer, etag, self.storage.file_size(section))
+        extra = f"ETag: {etag}\r\nCache-Control: {CACHE_REVALIDATE}\r\nVary: Accept, Accept-Encoding\r\n"
+        if self.is_not_modified(writer, etag):
+            return await self.send_not_modified(writer, extra)
+
+        if content_type == NDJSON_TYPE:
+            await self.send_response_header(writer, "200 OK", content_type, extra=extra)
+            if writer.head:
+                return
+            return await self.write_chunks(writer, iter_ndjson(self.storage.iter_records(section)))
+
+        # 小さいセクションはまとめてキャッシュし、Content-Length 付きで返す
+        body = self.cached_json(section, required=False)
+        if body is not None:
+            return await self.send_body(writer, "200 OK", content_type, body, extra)
+        await self.send_response_header(writer, "200 OK", content_type, extra=extra)
+        if writer.head:
+            return
+        await self.write_chunks(writer, iter_json_array(self.storage.iter_records(section)))
+
+    def cached_json(self, section, required=True):
+        # 保存されるまで同じ本文なので、CSV の解析と ujson.dumps は最初の 1 回だけにする
+        # キャッシュの参照はすべてここを通し、ヒットとミスを数える。
+        # required でなければ、キャッシュに入らない大きさのセクションは作らずに None を返す (呼び出し側で流す)
+        body = self.cache.get(section)
+        if body is not None:
+            self.metrics.count("cache_hits")
+            return body
+        self.metrics.count("cache_misses")
+        if not required and self.storage.file_size(section) * 2 > self.cache.max_entry:
+            return None
+        if section == "user":
+            body = ujson.dumps(self.storage.read_user()).encode()
+        else:
+            body = b"".join(iter_json_array(self.storage.iter_records(section)))
+        self.cache.put(section, body)
+        return body
 
     async def handle_api_user(self, method, data, writer):
-        return await self.api_get_handler(method, self.storage.read_user, writer)
+        return await self.api_get_handler(method, "user", writer)
 
     async def handle_api_simplehist(self, method, data, writer):
-        return await self.api_get_handler(method, self.storage.read_simplehist, writer)
+        return await self.api_get_handler(method, "simplehist", writer)
 
     async def handle_api_jobhist(self, method, data, writer):
-        return await self.api_get_handler(method, self.storage.read_jobhist, writer)
+        return await self.api_get_handler(method, "jobhist", writer)
 
     async def handle_api_portrait(self, method, data, writer):
-        return await self.api_get_handler(method, self.storage.read_portrait, writer)
+        return await self.api_get_handler(method, "portrait", writer)
 
     async def handle_api_network(self, method, data, writer):
-        if method != "GET":
-            return await self.send_chunked(writer, b"Method not allowed")
+        return await self.send_json(writer, self.network_info())
 
+    def network_info(self):
         info = {
             "ap": {
-                "ip": "192.168.4.1",
+                "ip": AP_IP,
                 "netmask": "255.255.255.0"
             },
             "sta": None
@@ -479,20 +1480,67 @@ class WebServer:
                 "gateway": sta_if[2],
                 "dns": sta_if[3]
             }
-
-        json_data = ujson.dumps(info)
-        return await self.send_chunked(writer, json_data.encode())
+        return info
+
+    async def handle_api_resume(self, method, data, writer):
+        # index.js が個別に取得していた各セクションを 1 つの JSON オブジェクトにまとめて流す
+        network = self.network_info()
+        etag = self.storage.etag("user", "simplehist", "jobhist", "portrait")
+        if network["sta"]:
+            # STA の IP が変わると管理画面の表示判定が変わるため ETag に含める
+            etag = etag[:-1] + "-" + network["sta"]["ip"] + '"'
+        etag = self.negotiate_gzip(writer, etag)
+        extra = f"ETag: {etag}\r\nCache-Control: {CACHE_REVALIDATE}\r\nVary: Accept-Encoding\r\n"
+        if self.is_not_modified(writer, etag):
+            return await self.send_not_modified(writer, extra)
+
+        await self.send_response_header(writer, "200 OK", "application/json", extra=extra)
+        if writer.head:
+            return
+        writer.write(b'{"user":')
+        await self.send_chunked(writer, self.cached_json("user"))
+        for section in ("simplehist", "jobhist", "portrait"):
+            writer.write(b',"' + section.encode() + b'":')
+            body = self.cached_json(section, required=False)
+            if body is not None:
+                await self.send_chunked(writer, body)
+            else:
+                await self.write_chunks(writer, iter_json_array(self.storage.iter_records(section)))
+        writer.write(b',"network":')
+        await self.send_chunked(writer, ujson.dumps(network).encode())
+        writer.write(b'}')
+        await writer.drain()
 
     async def handle_admin_log(self, method, data, writer):
-        if method != "GET":
-            return await self.send_chunked(writer, b"Method not allowed")
         try:
-            with open("/log.txt", "r") as file_obj:
-                while True:
-                    chunk = file_obj.read(BUFFER_SIZE)
-                    if not chunk:
-                        break
-                    writer.write(chunk.encode("utf-8"))
-                    await writer.drain()
+            size = os.stat("/log.txt")[6]
         except OSError:
-            pass
+            return await self.send_body(writer, "200 OK", "text/plain", b"")
+        await self.send_response_header(writer, "200 OK", "text/plain", size)
+        if not writer.head:
+            await self._write_file(writer, "/log.txt", size)
+
+    async def handle_admin_metrics(self, method, data, writer):
+        report = self.metrics.report()
+        report["rate_limit"] = self.limiter.report()
+        if self.dns:
+            report["dns"] = self.dns.stats()
+        if self.loop_monitor:
+            report["loop"] = self.loop_monitor.report()
+        return await self.send_json(writer, report, extra=f"Cache-Control: {CACHE_REVALIDATE}\r\n")
+
+    async def handle_admin_dns(self, method, data, writer):
+        # GET: 問い合わせの多い名前の一覧。POST {"name": ..., "action": "nxdomain"}: 名前に返す応答を変える
+        if not self.dns:
+            return await self.send_error(writer, "404 Not Found", "DNS server not available")
+        if method in ("GET", "HEAD"):
+            return await self.send_json(writer, self.dns.report(), extra=f"Cache-Control: {CACHE_REVALIDATE}\r\n")
+        if data is None:
+            return await self.send_error(writer, "400 Bad Request", "Empty Body")
+        records = []
+        try:
+            await self.read_json_body(data, writer.buf, records.append, False)
+            self.dns.set_rule(records[0].get("name", ""), records[0].get("action", "default"))
+        except (UnicodeError, ValueError, AttributeError):
+            return await self.send_error(writer, "400 Bad Request", "Bad DNS rule")
+        return await self.send_json(writer, {"status": "success"})
@@ -5,8 +5,18 @@ document.addEventListener("DOMContentLoaded", async () => {
   const jobhistInfo = document.getElementById("jobhist-info");
   const portraitInfo = document.getElementById("portrait-info");
 
-  const user = await (await fetch("/api/user")).json();
-  const simplehist = await (await fetch("/api/simplehist")).json();
+  // サーバーが保存時にデータを埋め込んだページ (スナップショット) なら取得も描画も不要
+  if (document.body.dataset.snapshot) {
+    dateTime.innerHTML = getTodayFormatted();
+    checkServerNetwork();
+    renderDeferredMarkdown();
+    return;
+  }
+
+  // 全セクションとネットワーク情報を 1 回のリクエストで取得する
+  const resume = await (await fetch("/api/resume")).json();
+  const { user, simplehist, jobhist, portrait } = resume;
+  checkServerNetwork(resume.network);
 
   if (Object.keys(user).length === 0 && simplehist.length === 0) {
     userInfo.innerHTML = "<p>データなし</p>";
@@ -92,7 +102,6 @@ document.addEventListener("DOMContentLoaded", async () => {
     </ul>
   `;
 
-  const jobhist = await (await fetch("/api/jobhist")).json();
   jobhistInfo.innerHTML = `
     ${jobhist
       .map(
@@ -106,7 +115,6 @@ document.addEventListener("DOMContentLoaded", async () => {
       .join("")}
   `;
 
-  const portrait = await (await fetch("/api/portrait")).json();
   portraitInfo.innerHTML = `
     ${portrait
       .map(
@@ -125,6 +133,23 @@ document.addEventListener("DOMContentLoaded", async () => {
   `;
 });
 
+/**
+ * スナップショットのうち、サーバーで変換できない記法を含む Markdown (data-markdown) を marked で描画する
+ * marked はその場合だけ読み込む
+ */
+function renderDeferredMarkdown() {
+  const blocks = document.querySelectorAll("[data-markdown]");
+  if (blocks.length === 0) return;
+  const script = document.createElement("script");
+  script.src = "/lib/marked.min.js";
+  script.onload = () => {
+    blocks.forEach((block) => {
+      block.innerHTML = parseMarkdown(block.textContent);
+    });
+  };
+  document.head.appendChild(script);
+}
+
 function parseMarkdown(text) {
   if (!text) return "";
   if (typeof marked !== "undefined" && marked.parse) {
@@ -172,7 +197,8 @@ function toggleAdminElements(show) {
   });
 }
 
-async function checkServerNetwork() {
+// info を渡さない場合は /api/network から取得する
+async function checkServerNetwork(info) {
   const currentHost = window.location.hostname;
   const adminNetworks = [];
 
@@ -182,22 +208,25 @@ async function checkServerNetwork() {
     mask: ipToNum("255.255.255.0"),
   });
 
-  try {
-    const res = await fetch("/api/network");
-    if (res.ok) {
-      const info = await res.json();
-      if (info.sta && info.sta.ip) {
-        const staIp = ipToNum(info.sta.ip);
-        const staMask = ipToNum(info.sta.netmask);
-        const staBase = staIp & staMask;
-        adminNetworks.push({
-          base: staBase,
-          mask: staMask,
-        });
+  if (!info) {
+    try {
+      const res = await fetch("/api/network");
+      if (res.ok) {
+        info = await res.json();
       }
+    } catch (e) {
+      console.warn("Failed to fetch network info", e);
     }
-  } catch (e) {
-    console.warn("Failed to fetch network info", e);
+  }
+
+  if (info && info.sta && info.sta.ip) {
+    const staIp = ipToNum(info.sta.ip);
+    const staMask = ipToNum(info.sta.netmask);
+    const staBase = staIp & staMask;
+    adminNetworks.push({
+      base: staBase,
+      mask: staMask,
+    });
   }
 
   const isIp =
@@ -216,11 +245,6 @@ async function checkServerNetwork() {
   return isAdmin;
 }
 
-// ページロード時に実行
-document.addEventListener("DOMContentLoaded", function () {
-  checkServerNetwork();
-});
-
 function recheckServerNetwork() {
   return checkServerNetwork();
 }
@@ -1,7 +1,7 @@
 document.addEventListener("DOMContentLoaded", async () => {
   const form = document.getElementById("user-form");
   const response = await fetch("/api/user");
-  const user = await response.json();
+  const user = response.ok ? await readJson(response) : {};
 
   form.usr_name.value = user.usr_name || "";
   form.usr_name_kana.value = user.usr_name_kana || "";
@@ -93,49 +93,217 @@ async function uploadImage() {
   progressBar.value = 0;
   progressText.textContent = "0%";
 
-  const chunkSize = 1024;
-  const totalChunks = Math.ceil(file.size / chunkSize);
-  const filename = "tmp.jpg";
+  // サーバーの画像と同じなら送らない
+  const digest = await sha256Hex(file);
+  if (digest) {
+    try {
+      const res = await fetch("/api/upload", {
+        method: "HEAD",
+        headers: { "If-None-Match": `"${digest}"` },
+      });
+      if (res.status === 304) {
+        progressBar.value = 100;
+        progressText.textContent = "同じ画像がアップロード済みです";
+        return;
+      }
+    } catch (e) {
+      console.warn("Failed to check uploaded image", e);
+    }
+  }
 
-  for (let i = 0; i < totalChunks; i++) {
-    const start = i * chunkSize;
-    const end = Math.min(file.size, start + chunkSize);
-    const chunk = file.slice(start, end);
-    const isFinal = i === totalChunks - 1;
+  // まず 1 回のリクエストで全体を送り、接続が切れたら再開できるセッション方式に切り替える
+  const digestHeaders = digest ? { "X-Content-SHA256": digest } : {};
+  progressText.textContent = "送信中...";
+  let response = null;
+  try {
+    response = await fetch("/api/upload", {
+      method: "POST",
+      headers: digestHeaders,
+      body: file,
+    });
+  } catch (error) {
+    console.warn("一括アップロードが中断したため分割して送ります:", error);
+  }
+  if (response) {
+    const result = await readJson(response);
+    if (!response.ok) {
+      console.error("アップロードに失敗しました:", result.message);
+      progressText.textContent = "アップロード失敗";
+      return;
+    }
+    progressBar.value = 100;
+    reloadImage();
+    progressText.textContent = "アップロード完了";
+    return;
+  }
 
-    const headers = new Headers();
-    headers.append("X-Filename", filename);
-    headers.append("X-Final", isFinal.toString());
+  if (await uploadResumable(file, digestHeaders, progressBar, progressText)) {
+    reloadImage();
+    progressText.textContent = "アップロード完了";
+  }
+}
 
+/**
+ * レスポンスの本文を JSON として読む
+ * 429/503 などサーバーが本文なしで返す応答では、ステータスをメッセージにしたオブジェクトを返す
+ */
+async function readJson(response) {
+  const type = response.headers.get("Content-Type") || "";
+  if (type.includes("application/json")) {
     try {
-      const response = await fetch("/api/upload", {
-        method: "POST",
-        headers,
-        body: chunk,
-      });
+      return await response.json();
+    } catch (e) {
+      console.warn("Failed to parse response", e);
+    }
+  }
+  return { message: `${response.status} ${response.statusText}` };
+}
+
+async function sha256Hex(file) {
+  const data = await file.arrayBuffer();
+  // crypto.subtle は https か localhost でのみ使える。AP の http では JavaScript で計算する
+  const hash =
+    window.crypto && crypto.subtle
+      ? new Uint8Array(await crypto.subtle.digest("SHA-256", data))
+      : sha256(new Uint8Array(data));
+  return Array.from(hash)
+    .map((b) => b.toString(16).padStart(2, "0"))
+    .join("");
+}
+
+const SHA256_K = new Uint32Array([
+  0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+  0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+  0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+  0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+  0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+  0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+  0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+  0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]);
+
+/**
+ * SHA-256 (FIPS 180-4) を計算する。crypto.subtle が使えない場合の代わり
+ */
+function sha256(bytes) {
+  // 末尾に 0x80、0 埋め、ビット長 (64 ビット、ビッグエンディアン) を付けて 64 バイトの倍数にする
+  const length = Math.ceil((bytes.length + 9) / 64) * 64;
+  const padded = new Uint8Array(length);
+  padded.set(bytes);
+  padded[bytes.length] = 0x80;
+  const view = new DataView(padded.buffer);
+  view.setUint32(length - 8, Math.floor(bytes.length / 0x20000000));
+  view.setUint32(length - 4, bytes.length * 8);
+
+  const h = new Uint32Array([
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+  ]);
+  const w = new Uint32Array(64);
+  const rotr = (x, n) => (x >>> n) | (x << (32 - n));
+  for (let offset = 0; offset < length; offset += 64) {
+    for (let i = 0; i < 16; i++) w[i] = view.getUint32(offset + i * 4);
+    for (let i = 16; i < 64; i++) {
+      const s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+      const s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+      w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    let [a, b, c, d, e, f, g, hh] = h;
+    for (let i = 0; i < 64; i++) {
+      const t1 = hh + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i];
+      const t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+      hh = g;
+      g = f;
+      f = e;
+      e = (d + t1) >>> 0;
+      d = c;
+      c = b;
+      b = a;
+      a = (t1 + t2) >>> 0;
+    }
+    h[0] += a;
+    h[1] += b;
+    h[2] += c;
+    h[3] += d;
+    h[4] += e;
+    h[5] += f;
+    h[6] += g;
+    h[7] += hh;
+  }
+  const digest = new Uint8Array(32);
+  const out = new DataView(digest.buffer);
+  for (let i = 0; i < 8; i++) out.setUint32(i * 4, h[i]);
+  return digest;
+}
+
+async function uploadResumable(file, digestHeaders, progressBar, progressText) {
+  // セッションを作り、サーバーが示す大きさのチャンクをオフセット付きで送る
+  let session;
+  try {
+    const res = await fetch("/api/upload", {
+      method: "POST",
+      headers: { "Upload-Length": String(file.size) },
+    });
+    session = await readJson(res);
+    if (!res.ok) throw new Error(session.message);
+  } catch (error) {
+    console.error("アップロードを開始できませんでした:", error);
+    progressText.textContent = "アップロード失敗";
+    return false;
+  }
 
-      const result = await response.json();
-      console.log(`Chunk ${i + 1}/${totalChunks}:`, result);
+  const url = `/api/upload/${session.id}`;
+  let offset = session.offset;
+  let retries = 0;
 
-      const progress = Math.round(((i + 1) / totalChunks) * 100);
-      progressBar.value = progress;
-      progressText.textContent = `${progress}%`;
+  while (offset < file.size) {
+    const chunk = file.slice(offset, Math.min(file.size, offset + session.max_chunk));
+    try {
+      const response = await fetch(url, {
+        method: "PUT",
+        headers: { "Upload-Offset": String(offset) },
+        body: chunk,
+      });
+      const result = await readJson(response);
+      // 409 はオフセットのずれ。サーバーの受信済みの長さから続ける
+      if (!response.ok && response.status !== 409) throw new Error(result.message);
+      offset = result.offset;
+      retries = 0;
     } catch (error) {
       console.error("アップロード中にエラーが発生しました:", error);
-      break;
+      if (++retries > 3) {
+        progressText.textContent = "アップロード失敗";
+        return false;
+      }
+      // 接続が切れた場合は受信済みの長さを問い合わせて再開する
+      try {
+        const status = await fetch(url, { cache: "no-store" });
+        if (status.ok) offset = (await status.json()).offset;
+      } catch (e) {
+        console.warn("Failed to fetch upload status", e);
+      }
+      continue;
     }
+
+    const progress = Math.round((offset / file.size) * 100);
+    progressBar.value = progress;
+    progressText.textContent = `${progress}%`;
   }
 
-  reloadImage();
-  progressText.textContent = "アップロード完了";
+  try {
+    const response = await fetch(url, { method: "POST", headers: digestHeaders });
+    if (!response.ok) throw new Error((await readJson(response)).message);
+  } catch (error) {
+    console.error("アップロードを確定できませんでした:", error);
+    progressText.textContent = "アップロード失敗";
+    return false;
+  }
+  return true;
 }
 
 function reloadImage() {
   const img = document.getElementById("userImage");
-  // タイムスタンプを追加してキャッシュを強制的に無効化
-  const timestamp = new Date().getTime();
-
-  fetch(`/image.jpg?t=${timestamp}`, { cache: "no-store" })
+  // ETag で再検証させ、画像が変わったときだけ本文を受け取る
+  fetch("/image.jpg", { cache: "no-cache" })
     .then((res) => res.blob())
     .then((blob) => {
       const blobUrl = URL.createObjectURL(blob);